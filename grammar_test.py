@@ -1,6 +1,5 @@
 #!/bin/env python
 import argparse
-import re
 from stabby import grammar, text_utils
 
 parser = argparse.ArgumentParser()
@@ -10,15 +9,38 @@ subparsers.required = True
 
 maker_parser = subparsers.add_parser('maker')
 test_parser = subparsers.add_parser('test')
+analyze_parser = subparsers.add_parser('analyze')
 
 test_parser.add_argument('root_symbol', default='ROOT', help="The symbol to start with")
+analyze_parser.add_argument('root_symbols', nargs='*', help="The symbols to analyze, defaults to every symbol nothing else expands into")
+analyze_parser.add_argument('--max-depth', type=int, default=grammar.DEFAULT_MAX_DEPTH, help="Depth limit to estimate the cut-off chance for")
+analyze_parser.add_argument('--benchmark', type=int, default=0, metavar='COUNT', help="Also time generating COUNT prompts per symbol")
 args = parser.parse_args()
 
 language = grammar.Grammar(args.filename)
 
 if args.subcommand == 'test':
-    for i in range(0, 25):
-        print(language.generate(start=args.root_symbol))
+    for text in language.generate_many(25, start=args.root_symbol):
+        print(text)
+elif args.subcommand == 'analyze':
+    analysis = language.analyze(starts=args.root_symbols or None, max_depth=args.max_depth)
+    print('{:<24} {:>10} {:>10} {:>14}'.format('symbol', 'expansions', 'length', 'p(depth>{})'.format(args.max_depth)))
+    for symbol in analysis.symbols:
+        print('{:<24} {:>10.2f} {:>10.2f} {:>14.3g}'.format(
+            symbol.start, symbol.expected_expansions, symbol.expected_length, symbol.depth_limit_probability))
+
+    if args.benchmark:
+        print()
+        print('{:<24} {:>14} {:>14} {:>14}'.format('symbol', 'prompts/s', 'batched/s', 'bytes/prompt'))
+        for symbol in analysis.symbols:
+            single = language.benchmark(symbol.start, args.benchmark)
+            batched = language.benchmark(symbol.start, args.benchmark, batched=True)
+            print('{:<24} {:>14.0f} {:>14.0f} {:>14.0f}'.format(
+                symbol.start, single.prompts_per_second, batched.prompts_per_second, single.peak_bytes_per_prompt))
+
+    print()
+    print('Unreachable symbols: {}'.format(', '.join(analysis.unreachable) or 'none'))
+    print('Possibly undefined symbols: {}'.format(', '.join(analysis.undefined) or 'none'))
 elif args.subcommand == 'maker':
     params = dict(
         subject=None,
@@ -39,15 +61,4 @@ elif args.subcommand == 'maker':
     )
 
     prompt = text_utils.template_grammar_fill(params, language, True)
-
-    prompt_text = ''
-    for joint_fields in [
-        ['subject', 'object', 'action'],
-        ['perspective', 'quality', 'medium', 'style'],
-    ]:
-        prompt_text += ' '.join([prompt.pop(field, '') for field in joint_fields])
-        prompt_text += ', '
-
-    prompt_text += ', '.join([v for v in prompt.values() if v])
-    prompt_text = re.sub(r'[ ]+', ' ', prompt_text)
-    print(prompt_text)
+    print(text_utils.join_template_prompt(prompt))
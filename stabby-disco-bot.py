@@ -6,7 +6,7 @@ from hypercorn.asyncio import serve
 from hypercorn.config import Config as HyperConfig
 
 import stabby
-from stabby import conf, bot, schema
+from stabby import conf, bot, generation, prompts, schema
 from stabby.bot import client
 from stabby.handlers import app
 
@@ -27,6 +27,7 @@ async def cleanup():
     finally:
         logger.info("Starting cleanup")
         await stabby.close_http_client()
+        generation.shutdown_render_executor()
 
 
 async def run_app():
@@ -41,6 +42,8 @@ async def run_app():
 
         client.loop.create_task(cleanup())
 
+        client.loop.create_task(prompts.get_pool().run())
+
         await bot.client.start(config.token)
 
 try:
@@ -0,0 +1,292 @@
+import asyncio
+import contextlib
+import dataclasses
+import functools
+import logging
+import time
+from typing import AsyncIterator, Callable, Collection, Optional
+
+import aiohttp
+from sqlalchemy import select
+
+from stabby import conf, schema
+
+logger = logging.getLogger('discord.stabby.backends')
+
+# Weight of the newest request in the per-backend latency and step time averages
+LATENCY_SMOOTHING = 0.2
+
+
+class GenerationError(Exception):
+    """A generation that did not produce an image.
+
+    retryable is set when another attempt, possibly on another backend, could succeed.
+    """
+    retryable = True
+
+
+class NoBackendAvailable(GenerationError):
+    retryable = False
+
+
+class BackendTimeout(GenerationError):
+    pass
+
+
+class RequestRejected(GenerationError):
+    """The backend refused the request itself, so the backend is fine and retrying will not help."""
+    retryable = False
+
+
+class CircuitBreaker:
+    """Stops sending work to a backend after failure_threshold failures in a row.
+
+    Once open, the backend gets nothing for cooldown seconds. After that it is
+    half-open: a single trial request or probe decides whether it closes again
+    or opens for another cooldown.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int, cooldown: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allows(self) -> bool:
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self.trial)
+
+    def begin(self) -> None:
+        if self.state == self.HALF_OPEN:
+            self.trial = True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = self.clock()
+
+
+def default_breaker() -> CircuitBreaker:
+    config = conf.load_conf()
+    return CircuitBreaker(config.breaker_failures, config.breaker_cooldown)
+
+
+@dataclasses.dataclass(eq=False)
+class Backend:
+    url: str
+    token: Optional[str] = None
+    in_flight: int = 0
+    completed: int = 0
+    failed: int = 0
+    latency: Optional[float] = None
+    # Seconds per unit of work, one step of one megapixel image
+    step_time: Optional[float] = None
+    last_seen: Optional[float] = None
+    breaker: CircuitBreaker = dataclasses.field(default_factory=default_breaker)
+
+    @property
+    def headers(self) -> dict[str, str]:
+        if not self.token:
+            return {}
+        return {'Authorization': 'Bearer {}'.format(self.token)}
+
+    @property
+    def observed_online(self) -> bool:
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    def timeout(self, work: float) -> float:
+        """How long a request for this much work may take before it counts as hung."""
+        config = conf.load_conf()
+        if self.step_time is None:
+            return config.generation_timeout
+        return max(config.generation_timeout_min, config.generation_timeout_factor * self.step_time * work)
+
+    def record(self, elapsed: float, ok: bool, work: Optional[float] = None) -> None:
+        if ok:
+            self.completed += 1
+            self.last_seen = time.monotonic()
+            self.breaker.success()
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+            if work:
+                if self.step_time is None:
+                    self.step_time = elapsed / work
+                else:
+                    self.step_time += LATENCY_SMOOTHING * (elapsed / work - self.step_time)
+        else:
+            self.failed += 1
+            self.breaker.failure()
+
+    async def ping(self, http_client: aiohttp.ClientSession) -> bool:
+        try:
+            async with http_client.head(self.url, headers=self.headers, timeout=10) as response:
+                online = response.status in (200, 204)
+        except Exception:
+            online = False
+
+        if not online:
+            self.breaker.failure()
+        elif self.breaker.state == CircuitBreaker.HALF_OPEN:
+            # The probe is the trial, a request will confirm it soon enough
+            self.breaker.success()
+        if online:
+            self.last_seen = time.monotonic()
+        return online
+
+    def stats(self) -> dict:
+        return dict(
+            in_flight=self.in_flight,
+            completed=self.completed,
+            failed=self.failed,
+            latency=self.latency,
+            step_time=self.step_time,
+            online=self.observed_online,
+            breaker=self.breaker.state,
+        )
+
+
+class BackendPool:
+    """The Stable Diffusion servers generations can be sent to.
+
+    Each job goes to the healthy backend with the fewest jobs in flight, with
+    ties going to the one that has been answering fastest. A backend is healthy
+    while its circuit breaker lets requests through.
+    """
+
+    def __init__(self, backends: list[Backend], loader: Optional[Callable[[], list[Backend]]] = None) -> None:
+        self.backends = backends
+        self.loader = loader
+        self.refreshed_at = time.monotonic()
+
+    @property
+    def available(self) -> bool:
+        return any(backend.observed_online for backend in self.backends)
+
+    def select(self, avoid: Collection[Backend] = ()) -> Backend:
+        healthy = [backend for backend in self.backends if backend.breaker.allows()]
+        if not healthy:
+            raise NoBackendAvailable("None of the {} generation servers are online".format(len(self.backends)))
+        # A retry goes somewhere new if it can, the backend that just failed is likely to again
+        healthy = [backend for backend in healthy if backend not in avoid] or healthy
+        # Backends that have not answered yet sort first, so each one gets measured
+        return min(healthy, key=lambda backend: (backend.in_flight, backend.latency or 0.0))
+
+    @contextlib.asynccontextmanager
+    async def use(self, work: Optional[float] = None, avoid: Optional[set[Backend]] = None) -> AsyncIterator[Backend]:
+        backend = self.select(avoid or ())
+        if avoid is not None:
+            avoid.add(backend)
+        backend.breaker.begin()
+        backend.in_flight += 1
+        began = time.perf_counter()
+        try:
+            yield backend
+        except RequestRejected:
+            # The backend answered fine, it was the request that was bad
+            backend.failed += 1
+            backend.breaker.trial = False
+            raise
+        except Exception:
+            backend.record(time.perf_counter() - began, False)
+            raise
+        except BaseException:
+            # Cancelled from our side, which says nothing about the backend
+            backend.breaker.trial = False
+            raise
+        else:
+            backend.record(time.perf_counter() - began, True, work)
+        finally:
+            backend.in_flight -= 1
+
+    async def check(self, http_client: aiohttp.ClientSession) -> bool:
+        """Probe the backends real requests have not vouched for lately, and report whether any is usable.
+
+        Open breakers are left alone until their cooldown is over, so a wedged
+        server is not hammered, and busy backends are judged by their requests.
+        Every backend_refresh_interval the backends are reloaded first, so
+        servers added to or removed from the database are picked up.
+        """
+        config = conf.load_conf()
+        idle = config.backend_probe_idle
+        now = time.monotonic()
+        if self.loader is not None and now - self.refreshed_at >= config.backend_refresh_interval:
+            self.refreshed_at = now
+            try:
+                self.refresh(await asyncio.to_thread(self.loader))
+            except Exception as ex:
+                logger.warning("Could not refresh the generation servers: {}".format(ex))
+
+        for backend in self.backends:
+            state = backend.breaker.state
+            if state == CircuitBreaker.OPEN or backend.in_flight:
+                continue
+            if state == CircuitBreaker.HALF_OPEN or backend.last_seen is None or now - backend.last_seen >= idle:
+                await backend.ping(http_client)
+        return self.available
+
+    def refresh(self, backends: list[Backend]) -> None:
+        """Switch to a new list of backends, keeping the state of those already in the pool.
+
+        Requests still running on a dropped backend finish normally.
+        """
+        current = {(backend.url, backend.token): backend for backend in self.backends}
+        self.backends = [current.get((backend.url, backend.token), backend) for backend in backends]
+
+    def stats(self) -> dict[str, dict]:
+        # By position rather than url, the metrics are public and the urls are internal hosts and user servers
+        return {'backend-{}'.format(index): backend.stats() for index, backend in enumerate(self.backends)}
+
+
+def configured_backends(config: conf.Conf, strict: bool = False) -> list[Backend]:
+    """The backends from the config and the database, without the database ones if it cannot be read.
+
+    With strict, a database error is raised instead.
+    """
+    backends = [Backend(url=url) for url in config.sd_hosts or [config.sd_host]]
+
+    try:
+        with schema.db_session() as session:
+            servers = session.scalars(select(schema.GenerationServer).where(
+                schema.GenerationServer.url.is_not(None),
+                schema.GenerationServer.status != schema.ServerStatus.Offline,
+            ))
+            backends.extend(Backend(url=server.url, token=server.token) for server in servers)
+    except Exception as ex:
+        if strict:
+            raise
+        logger.warning("Could not load generation servers from the database: {}".format(ex))
+
+    return backends
+
+
+_pool: Optional[BackendPool] = None
+
+
+def get_pool() -> BackendPool:
+    global _pool
+    if _pool is None:
+        config = conf.load_conf()
+        _pool = BackendPool(configured_backends(config), loader=functools.partial(configured_backends, config, strict=True))
+    return _pool
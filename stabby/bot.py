@@ -1,16 +1,15 @@
-import re
+import asyncio
 import traceback
 from typing import Any, Awaitable, Callable, Literal, Optional, List, cast, Type
 
 import logging
 import io
 import discord
-from PIL import Image
 from discord import Emoji, File, Message, PartialEmoji, app_commands
 from discord.ext import tasks
 from functools import wraps
 
-from stabby import conf, generation, grammar, schema
+from stabby import conf, generation, grammar, inputs, jobs, prompts, schema
 from stabby import text_utils
 from stabby import image
 from stabby.schema import Style, db_session, Preferences, Generation, ServerPreferences
@@ -23,9 +22,6 @@ from stabby.text_utils import apply_default_params
 
 config = conf.load_conf()
 logger = logging.getLogger('discord.stabby')
-karma_grammar = grammar.Grammar(config.karma_grammar)
-prompt_grammar = grammar.Grammar(config.prompt_grammar)
-maker_grammar = grammar.Grammar(config.maker_grammar)
 
 def generate_ratelimiter_with_contributor_whitelist(interaction: discord.Interaction) -> Optional[app_commands.Cooldown]:
     if interaction.user.id == config.owner_id:
@@ -206,7 +202,7 @@ async def generation_interaction(
     cfg_scale: Optional[float] = None,
     steps: Optional[int] = None,
     command_name: Optional[str] = 'Magic!',
-    input_image: Optional[Image.Image] = None,
+    input_image: Optional[inputs.InputImage] = None,
 ) -> None:
     assert interaction.guild is not None
 
@@ -282,10 +278,41 @@ async def generation_interaction(
             )
             new_params = apply_defaults(interaction, params)
 
-            file, reprompt_struct = await generation.generate_ai_image(
-                http_client=await stabby.get_http_client(),
-                **new_params
-            )
+            # A cached result needs no backend, so it does not wait in line behind the generations that do
+            cached = await generation.cached_result(new_params)
+            progress = None
+            if cached is not None:
+                file, reprompt_struct = cached
+            else:
+                if config.progress_edit_interval > 0:
+                    progress = new_params['progress'] = generation.ProgressFeed(previews=config.progress_previews)
+
+                try:
+                    job = jobs.get_queue().submit(new_params)
+                except jobs.QueueFull:
+                    display = stabby.text_utils.prettify_params(dict(
+                        prompt=prompt,
+                        negative_prompt=negative_prompt,
+                        overlay=overlay,
+                    ))
+                    await interaction_must_reply(interaction, "I'm swamped right now, try again in a bit. I've saved `{}` for later.".format(display), silent=True)
+                    return
+
+                if job.position:
+                    await interaction.followup.send("You are #{} in line".format(job.position), ephemeral=True, silent=True)
+
+                progress_task = None
+                if progress is not None:
+                    progress_task = asyncio.create_task(show_progress(interaction, progress))
+                try:
+                    file, reprompt_struct = await job
+                finally:
+                    if progress_task is not None:
+                        progress_task.cancel()
+
+            if progress is not None and progress.latest is not None:
+                # Replace the last progress update and its preview
+                await interaction.edit_original_response(content="Done!", attachments=[])
             await interaction.followup.send(stabby.text_utils.prettify_params(reprompt_struct), ephemeral=True)
 
             message = await interaction.followup.send(
@@ -313,6 +340,24 @@ async def generation_interaction(
         await interaction_must_reply(interaction, "Generation is offline right now, but I would have given you: {}".format(display), silent=True)
 
 
+async def show_progress(interaction: discord.Interaction, progress: generation.ProgressFeed) -> None:
+    """Keep the deferred response updated with the generation's progress, at most every progress_edit_interval seconds."""
+    try:
+        async for update in progress:
+            content = "Generating... {:.0%}".format(update.fraction)
+            if update.eta is not None:
+                content += " (about {:.0f}s left)".format(update.eta)
+
+            attachments = []
+            if update.preview is not None:
+                attachments.append(File(fp=io.BytesIO(update.preview), filename='preview.png'))
+
+            await interaction.edit_original_response(content=content, attachments=attachments)
+            await asyncio.sleep(config.progress_edit_interval)
+    except discord.HTTPException as ex:
+        logger.info("Stopped showing progress: {}".format(ex))
+
+
 async def default_error_handler(interaction: discord.Interaction, error: app_commands.AppCommandError):
     logger.error(error)
 
@@ -381,7 +426,7 @@ async def check_server_status():
 @ephemeral_ratelimiter
 async def inspire(interaction: discord.Interaction):
     """Some old fashioned AI inspiration"""
-    inspiration = prompt_grammar.generate()
+    inspiration = prompts.pop_fresh('prompt:ROOT', interaction.guild_id or interaction.user.id)
     await interaction.response.send_message(content=inspiration, silent=True)
 
 @client.tree.command()
@@ -427,7 +472,7 @@ async def prompt_maker(
 ):
     """Builds a prompt based on your inputs"""
     if quality is None and auto_quality and not random_fill:
-        quality = maker_grammar.generate(start='Quality')
+        quality = grammar.get_registry().get('maker').generate(start='Quality')
 
     params = dict(
         quality=quality,
@@ -447,18 +492,8 @@ async def prompt_maker(
         medium=medium,
     )
 
-    prompt = text_utils.template_grammar_fill(params, maker_grammar, random_fill)
-
-    prompt_text = ''
-    for joint_fields in [
-        ['subject', 'object', 'action'],
-        ['perspective', 'quality', 'medium', 'style'],
-    ]:
-        prompt_text += ' '.join([prompt.pop(field, '') for field in joint_fields])
-        prompt_text += ', '
-
-    prompt_text += ', '.join([v for v in prompt.values() if v])
-    prompt_text = re.sub(r'[ ]+', ' ', prompt_text)
+    prompt = text_utils.template_grammar_fill(params, grammar.get_registry().get('maker'), random_fill)
+    prompt_text = text_utils.join_template_prompt(prompt)
 
     await interaction.response.send_message(prompt_text, silent=True)
 
@@ -480,7 +515,7 @@ async def bezos(interaction: discord.Interaction):
 @generate_ratelimiter
 async def karma_wheel(interaction: discord.Interaction):
     """Spin the wheel, see what they get"""
-    prompt = karma_grammar.generate()
+    prompt = prompts.pop_fresh('karma:ROOT', interaction.guild_id or interaction.user.id)
 
     await generation_interaction(interaction, prompt=prompt, command_name='Karma wheel')
 
@@ -716,6 +751,19 @@ async def toggle_server_online(interaction: discord.Interaction):
                     await channel.send("Generation is now {}".format("available" if server_status.available else "unavailable"), silent=True)  # type: ignore
 
 
+@client.tree.command()
+@db_ratelimiter
+async def reload_grammars(interaction: discord.Interaction):
+    """Reload the prompt grammars from disk"""
+    if interaction.user.id != config.owner_id:
+        await interaction.response.send_message("Only the bot owner can do that...", silent=True, ephemeral=True)
+        return
+
+    reloaded = grammar.get_registry().reload()
+    prompts.get_pool().clear()
+    await interaction.response.send_message("Reloaded grammars: {}".format(', '.join(reloaded)), silent=True, ephemeral=True)
+
+
 @client.tree.command()
 @app_commands.describe(
     name='The name for the style'
@@ -823,14 +871,11 @@ async def ai_message_content(interaction: discord.Interaction, message: discord.
             message = resolved_message
 
     file = next(iter(message.attachments), None)
+    input_image = None
     if file:
-        image_bytes = io.BytesIO()
-        await file.save(image_bytes)
+        input_image = inputs.InputImage.from_attachment(file, message.id)
 
-        file = Image.open(image_bytes)
-        file.info['message_id'] = message.id
-
-    await generation_interaction(interaction, prompt=prompt, negative_prompt=negative, input_image=file, command_name='AI-ify this bad boy!',)
+    await generation_interaction(interaction, prompt=prompt, negative_prompt=negative, input_image=input_image, command_name='AI-ify this bad boy!',)
 
 
 def only_self_messages(f: Callable):
@@ -1000,18 +1045,14 @@ class Tweak(discord.ui.Modal):
 
         params = apply_default_params(params, self.params)
 
-        file = None
+        input_image = None
         if self.file:
-            image_bytes = io.BytesIO()
-            await self.file.save(image_bytes)
-
-            file = Image.open(image_bytes)
-            file.info['message_id'] = self.message_id
+            input_image = inputs.InputImage.from_attachment(self.file, self.message_id)
 
         await generation_interaction(
             interaction,
             command_name='Promptification!',
-            input_image=file,
+            input_image=input_image,
             **params
         )
 
@@ -62,15 +62,49 @@ class Conf(pydantic.BaseModel):
     karma_grammar: str
     prompt_grammar: str
     maker_grammar: str
+    grammar_max_depth: int = pydantic.Field(default=32)
+    grammar_max_tokens: int = pydantic.Field(default=128)
+    grammar_cache_dir: Optional[str] = pydantic.Field(default=None)
+    prompt_pool_size: int = pydantic.Field(default=50)
+    prompt_pool_low_water: int = pydantic.Field(default=10)
+    recent_filter_size: int = pydantic.Field(default=0)
+    recent_filter_retries: int = pydantic.Field(default=5)
+    recent_filter_guilds: int = pydantic.Field(default=1000)
+    prompt_stream_max: int = pydantic.Field(default=100000)
     owner_id: int
     title_font: str = pydantic.Field(default='droid-sans-mono.ttf')
     artist_font: str = pydantic.Field(default='droid-sans-mono.ttf')
     sd_host: str = pydantic.Field(default='http://127.0.0.1:7860')
+    sd_hosts: list[str] = pydantic.Field(default_factory=lambda: list())
+    resolutions: Optional[list[tuple[pydantic.PositiveInt, pydantic.PositiveInt]]] = pydantic.Field(default=None)
+    breaker_failures: int = pydantic.Field(default=3)
+    breaker_cooldown: float = pydantic.Field(default=30.0)
+    backend_probe_idle: float = pydantic.Field(default=30.0)
+    backend_refresh_interval: float = pydantic.Field(default=60.0)
+    generation_timeout: float = pydantic.Field(default=300.0)
+    generation_timeout_min: float = pydantic.Field(default=30.0)
+    generation_timeout_factor: float = pydantic.Field(default=3.0)
+    generation_retries: int = pydantic.Field(default=2)
+    generation_retry_delay: float = pydantic.Field(default=1.0)
     guilds: list[int] = pydantic.Field(default_factory=lambda: list())
     status_notify: list[int] = pydantic.Field(default_factory=lambda: list())
     ratelimit_count: int = pydantic.Field(default=1)
     ratelimit_window: float = pydantic.Field(default=20.0)
     max_steps: int = pydantic.Field(default=50)
+    generation_workers: int = pydantic.Field(default=0)
+    generation_queue_depth: int = pydantic.Field(default=20)
+    generation_batch_max: int = pydantic.Field(default=4)
+    generation_batch_window: float = pydantic.Field(default=0.0)
+    result_cache_bytes: int = pydantic.Field(default=64 * 1024 * 1024)
+    result_cache_dir: Optional[str] = pydantic.Field(default=None)
+    result_cache_disk_bytes: int = pydantic.Field(default=1024 * 1024 * 1024)
+    render_executor: Literal['process', 'thread', 'inline'] = pydantic.Field(default='thread')
+    render_workers: int = pydantic.Field(default=2)
+    input_cache_bytes: int = pydantic.Field(default=64 * 1024 * 1024)
+    overlay_cache_bytes: int = pydantic.Field(default=32 * 1024 * 1024)
+    progress_interval: float = pydantic.Field(default=1.0)
+    progress_edit_interval: float = pydantic.Field(default=3.0)
+    progress_previews: bool = pydantic.Field(default=True)
     global_defaults: GlobalDefaults
     db: DatabaseSettings
 
@@ -1,9 +1,17 @@
+import asyncio
+import concurrent.futures
 import dataclasses
-from typing import Any, Optional
+import functools
+import inspect
+import itertools
+import random
+from typing import Any, AsyncIterator, Optional
 import base64
+import binascii
 import json
 import re
 import io
+import uuid
 import aiohttp
 from PIL import Image
 from PIL.ImageEnhance import Contrast, Sharpness, Brightness, Color
@@ -12,7 +20,8 @@ from hashlib import sha512
 from discord import File
 import logging
 
-from stabby import conf, image
+from stabby import backends, conf, image, inputs, result_cache
+from stabby.backends import GenerationError
 from stabby.text_utils import prompt_to_overlay, prettify_params
 config = conf.load_conf()
 logger = logging.getLogger('discord.stabby.generator')
@@ -29,12 +38,7 @@ class ServerStatus:
 
 
 async def ping_server(http_client: aiohttp.ClientSession) -> bool:
-    url = config.sd_host
-    try:
-        async with http_client.head(url, timeout=10) as response:
-            return response.status in (200, 204)
-    except Exception:
-        return False
+    return await backends.get_pool().check(http_client)
 
 async def generate_ai_image(
         http_client: aiohttp.ClientSession,
@@ -53,133 +57,645 @@ async def generate_ai_image(
         suppress_description: bool = False,
         resize_dimensions: Optional[tuple[int, int]] = None,
         palette: Optional[str] = None,
-        input_image: Optional[Image.Image] = None,
+        input_image: Optional[inputs.InputImage] = None,
         format: Optional[str] = None,
+        quantizer: str = 'pil',
+        resample: Optional[str] = None,
+        reducing_gap: Optional[float] = None,
+        progress: Optional['ProgressFeed'] = None,
+        pool: Optional[backends.BackendPool] = None,
 ) -> tuple[File, dict[str, Any]]:
+    params = {name: value for name, value in locals().items() if name not in ('http_client', 'pool')}
+    (result,) = await generate_ai_image_batch(http_client, [params], pool=pool)
+    return result
+
+
+GEN_INFO_FIELDS = [
+    "prompt",
+    "negative_prompt",
+    "seed",
+    "sampler_name",
+    "scheduler",
+    "steps",
+    "cfg_scale",
+    "width",
+    "height",
+    "restore_faces",
+    "tiling",
+    "refiner_checkpoint",
+    "refiner_switch_at",
+    "sampler_index",
+]
+
+
+# Options applied after the backend call that still change the output, part of the result cache key
+RENDER_OPTIONS = [
+    "overlay",
+    "suppress_description",
+    "resize_dimensions",
+    "palette",
+    "format",
+    "quantizer",
+    "resample",
+    "reducing_gap",
+]
+
+
+def bind_params(params: dict[str, Any]) -> dict[str, Any]:
+    """Fill in generate_ai_image's defaults for everything params leaves out."""
+    bound = inspect.signature(generate_ai_image).bind(None, **params)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    del arguments['http_client'], arguments['pool']
+    return arguments
+
+
+def build_payload(params: dict[str, Any]) -> dict[str, Any]:
     payload = {
-        "prompt": prompt,
-        "negative_prompt": negative_prompt,
+        "prompt": params['prompt'],
+        "negative_prompt": params['negative_prompt'],
         "sampler_index": "DPM++ 2M",
-        "steps": steps,
-        "width": width,
-        "height": height,
-        "tiling": tiling,
-        "seed": seed,
-        "cfg_scale": cfg_scale,
-        "restore_faces": restore_faces,
+        "steps": params['steps'],
+        "width": params['width'],
+        "height": params['height'],
+        "tiling": params['tiling'],
+        "seed": params['seed'],
+        "cfg_scale": params['cfg_scale'],
+        "restore_faces": params['restore_faces'],
     }
 
-    if use_refiner:
+    if params['use_refiner']:
         payload.update({
             "refiner_switch_at": 0.8,
             "refiner_checkpoint": "sd_xl_refiner_1.0",
         })
 
-    filtered_payload = {
+    return {
         key: value for key, value in payload.items() if value is not None
     }
 
-    logger.info("Generating: {}".format(prettify_params(payload)))
-
-    endpoint = 'txt2img'
-    url = config.sd_host
 
-    if input_image:
-        endpoint = 'img2img'
-        filtered_payload['init_images'] = [image.b64_img(input_image)]
-        filtered_payload['resize_mode'] = 0
+def batch_key(params: dict[str, Any]) -> Optional[str]:
+    """Jobs with equal keys can share one txt2img call, None means the job has to run alone.
 
-    async with http_client.post(url=f'{url}/sdapi/v1/{endpoint}', json=filtered_payload) as response:
-        r = await response.json()
-
-        if not response.ok:
-            logger.error(filtered_payload)
-            logger.error(r)
-            logger.error(response)
-            raise Exception()
-
-        if not (r and r.get("images")):
-            raise Exception()
-
-        image_data = r["images"][0]
-
-        gen_info = json.loads(r["info"])
-        filtered_gen_info = {
-            key: value for key, value in gen_info.items() if key is not None and key in [
-                "prompt",
-                "negative_prompt",
-                "seed",
-                "sampler_name",
-                "scheduler",
-                "steps",
-                "cfg_scale",
-                "width",
-                "height",
-                "restore_faces",
-                "tiling",
-                "refiner_checkpoint",
-                "refiner_switch_at",
-                "sampler_index",
-            ]
-        }
-
-        if input_image:
-            filtered_payload['init_images'] = input_image.info.get('message_id', None)
-
-        reprompt_struct = filtered_payload
-        reprompt_struct.update(filtered_gen_info)
-        logger.info("Generated: {}".format(prettify_params(reprompt_struct)))
+    Only random seed text to image jobs are batched, since the backend picks
+    consecutive seeds for the images of a batch.
+    """
+    params = bind_params(params)
+    if params['input_image'] is not None or params['seed'] != -1:
+        return None
+    return json.dumps(build_payload(params), sort_keys=True)
 
-        raw_image = base64.b64decode(image_data.split(",", 1)[0])
-        image_hash = sha512(raw_image).hexdigest()
-        image_bytes = io.BytesIO(raw_image)
 
-        working_image = Image.open(image_bytes)
+async def generate_ai_image_batch(
+        http_client: aiohttp.ClientSession,
+        batch: list[dict[str, Any]],
+        pool: Optional[backends.BackendPool] = None,
+) -> list[tuple[File, dict[str, Any]]]:
+    """Generate every job in batch with a single backend call.
+
+    All jobs have to share a batch_key, unless there is only one. Post-processing
+    options like overlay, palette and resizing are still applied per job.
+    """
+    batch = [bind_params(params) for params in batch]
+    feeds = [params['progress'] for params in batch if params['progress'] is not None]
+    try:
+        return await _generate_batch(http_client, batch, pool, feeds)
+    finally:
+        for feed in feeds:
+            feed.close()
+
+
+def result_cache_key(params: dict[str, Any]) -> Optional[str]:
+    """Result cache key of a bound job, None unless a fixed seed makes its output repeatable."""
+    if params['seed'] == -1:
+        return None
+    # The output is a pure function of the payload and render options
+    payload = build_payload(params)
+    if params['input_image']:
+        payload.update(resize_mode=0, init_images=[params['input_image'].attachment_id])
+    return result_cache.result_key(payload, {option: params[option] for option in RENDER_OPTIONS})
+
+
+def cached_reply(params: dict[str, Any], key: str, cached: result_cache.CachedResult) -> tuple[File, dict[str, Any]]:
+    logger.info("Serving cached result {}".format(key[0:12]))
+    reprompt_struct = dict(cached.reprompt)
+    if params['input_image']:
+        reprompt_struct['init_images'] = params['input_image'].message_id
+    file = File(fp=io.BytesIO(cached.data), filename=cached.filename, description=params['prompt'], spoiler=params['spoiler'])
+    return file, reprompt_struct
+
+
+async def cached_result(params: dict[str, Any]) -> Optional[tuple[File, dict[str, Any]]]:
+    """The result of generate_ai_image(**params) if it is already cached, so the job never has to be queued."""
+    params = bind_params(params)
+    key = result_cache_key(params)
+    if key is None:
+        return None
+    cached = await result_cache.get_cache().fetch(key)
+    if cached is None:
+        return None
+    return cached_reply(params, key, cached)
+
+
+async def _generate_batch(
+        http_client: aiohttp.ClientSession,
+        batch: list[dict[str, Any]],
+        pool: Optional[backends.BackendPool],
+        feeds: list['ProgressFeed'],
+) -> list[tuple[File, dict[str, Any]]]:
+    first = batch[0]
+    filtered_payload = build_payload(first)
 
-        if palette is not None:
-            palette_seq = list(base64.urlsafe_b64decode(palette))
+    logger.info("Generating: {}".format(prettify_params(filtered_payload)))
 
-            palette_image = Image.new('P', (1, 1))
-            palette_image.putpalette(palette_seq)
+    endpoint = 'txt2img'
+    input_image = first['input_image']
 
-            for filter in [EDGE_ENHANCE]:
-                working_image = working_image.filter(filter)
+    if input_image:
+        endpoint = 'img2img'
+        filtered_payload['resize_mode'] = 0
 
-            for enhancement, level in (
-                (Brightness, 1.1),
-                (Color, 1.1),
-                (Sharpness, 2),
-                (Contrast, 1.6),
-            ):
-                enhancer = enhancement(working_image)
-                working_image = enhancer.enhance(level)
+    # Usually answered before the job was queued, but an identical job may have finished since
+    cache_key = result_cache_key(first) if len(batch) == 1 else None
+    if cache_key is not None:
+        cached = await result_cache.get_cache().fetch(cache_key)
+        if cached is not None:
+            return [cached_reply(first, cache_key, cached)]
 
-            working_image = working_image.convert('RGB').quantize(palette=palette_image)
+    request_payload = filtered_payload
+    if input_image:
+        request_payload = dict(filtered_payload, init_images=[await prepare_input_image(input_image, first['width'], first['height'])])
+    if len(batch) > 1:
+        request_payload = dict(filtered_payload, batch_size=len(batch))
+
+    if pool is None:
+        pool = backends.get_pool()
+
+    # Steps of one megapixel image, what backend timeouts and speeds are measured in
+    work = first['steps'] * first['width'] * first['height'] / 1e6 * len(batch)
+
+    # Only a fixed seed request is idempotent, anything else could come back as a different image
+    retries = config.generation_retries if len(batch) == 1 and first['seed'] != -1 else 0
+    tried: set[backends.Backend] = set()
+    for attempt in itertools.count():
+        try:
+            images, r = await request_images(http_client, pool, endpoint, request_payload, feeds, work, len(batch), tried)
+            break
+        except GenerationError as ex:
+            if not ex.retryable or attempt >= retries:
+                raise
+            delay = config.generation_retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning("Retrying generation in {:.1f}s: {}".format(delay, ex))
+            await asyncio.sleep(delay)
+
+    # With more than one image the backend may put a grid of them all in front
+    images = images[-len(batch):]
+
+    gen_info = json.loads(r["info"])
+    filtered_gen_info = {
+        key: value for key, value in gen_info.items() if key is not None and key in GEN_INFO_FIELDS
+    }
+    seeds = gen_info.get("all_seeds") or [gen_info.get("seed")] * len(batch)
+    # A backend that reports fewer seeds than images still owes every job a reply
+    seeds = list(seeds[:len(batch)]) + [None] * (len(batch) - len(seeds))
 
-        if resize_dimensions is not None:
-            logger.info("Resizing to {}".format(resize_dimensions))
-            working_image = working_image.resize(size=resize_dimensions)
+    if input_image:
+        filtered_payload['init_images'] = input_image.message_id
 
-        if overlay:
-            title, desc = prompt_to_overlay(prompt)
-            if suppress_description:
-                desc = None
+    reprompts = []
+    for seed in seeds:
+        reprompt_struct = dict(filtered_payload)
+        reprompt_struct.update(filtered_gen_info)
+        if seed is not None:
+            reprompt_struct['seed'] = seed
+        logger.info("Generated: {}".format(prettify_params(reprompt_struct)))
+        reprompts.append(reprompt_struct)
+
+    rendered = await asyncio.gather(*[
+        run_render(functools.partial(
+            render_image,
+            raw_image,
+            prompt=params['prompt'],
+            width=params['width'],
+            height=params['height'],
+            overlay=params['overlay'],
+            suppress_description=params['suppress_description'],
+            resize_dimensions=params['resize_dimensions'],
+            palette=params['palette'],
+            format=params['format'],
+            quantizer=params['quantizer'],
+            resample=params['resample'],
+            reducing_gap=params['reducing_gap'],
+        ))
+        for params, raw_image in zip(batch, images)
+    ])
+
+    results = []
+    for params, (data, filename), reprompt_struct in zip(batch, rendered, reprompts):
+        if cache_key is not None:
+            await result_cache.get_cache().store(cache_key, result_cache.CachedResult(
+                data=data,
+                filename=filename,
+                reprompt=dict(reprompt_struct),
+            ))
+        file = File(fp=io.BytesIO(data), filename=filename, description=params['prompt'], spoiler=params['spoiler'])
+        results.append((file, reprompt_struct))
+
+    return results
+
+
+async def prepare_input_image(input_image: inputs.InputImage, width: int, height: int) -> bytes:
+    """The img2img source as base64, downloaded and encoded only when not cached."""
+    cache = inputs.get_cache()
+    key = (input_image.attachment_id, width, height)
+    prepared = cache.get(key)
+    if prepared is None:
+        raw_image = await input_image.read()
+        prepared = await run_render(functools.partial(image.prepare_input, raw_image, width, height))
+        cache.put(key, prepared)
+    return prepared
+
+
+# Size of the pieces a request body is streamed in
+BODY_CHUNK = 64 * 1024
+
+
+def json_body(payload: dict[str, Any]) -> list[bytes]:
+    """payload as JSON in pieces, with the base64 init_images spliced in as they are.
+
+    Base64 never needs escaping in JSON, so the images are sent straight from
+    the input cache instead of being copied into one big string first.
+    """
+    images = payload.get('init_images') or []
+    rest = json.dumps({key: value for key, value in payload.items() if key != 'init_images'})
+    if not images:
+        return [rest.encode()]
+
+    pieces = [rest[:-1].encode(), b', "init_images": [' if len(rest) > 2 else b'"init_images": [']
+    for index, encoded in enumerate(images):
+        if index:
+            pieces.append(b', ')
+        pieces.extend([b'"data:image/png;base64,', encoded, b'"'])
+    pieces.append(b']}')
+    return pieces
+
+
+async def stream_body(pieces: list[bytes]) -> AsyncIterator[memoryview]:
+    for piece in pieces:
+        view = memoryview(piece)
+        for offset in range(0, len(view), BODY_CHUNK):
+            yield view[offset:offset + BODY_CHUNK]
+
+
+async def request_images(
+        http_client: aiohttp.ClientSession,
+        pool: backends.BackendPool,
+        endpoint: str,
+        payload: dict[str, Any],
+        feeds: list['ProgressFeed'],
+        work: float,
+        count: int,
+        tried: Optional[set[backends.Backend]] = None,
+) -> tuple[list[bytes], dict[str, Any]]:
+    """Make one backend call, with a timeout from that backend's measured speed.
+
+    The backend used is added to tried, and backends already in it are avoided.
+    """
+    async with pool.use(work, tried) as backend:
+        polling = None
+        if feeds:
+            # Tag the call so its progress can be told apart from other calls to the same backend
+            task_id = 'task({})'.format(uuid.uuid4().hex)
+            payload = dict(payload, force_task_id=task_id)
+            polling = asyncio.create_task(poll_progress(http_client, backend, task_id, feeds))
+
+        timeout = backend.timeout(work)
+        pieces = json_body(payload)
+        headers = dict(backend.headers, **{
+            'Content-Type': 'application/json',
+            'Content-Length': str(sum(len(piece) for piece in pieces)),
+        })
+        try:
+            async with http_client.post(
+                url=f'{backend.url}/sdapi/v1/{endpoint}',
+                data=stream_body(pieces),
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                body = await response.read()
+
+                if not response.ok:
+                    logger.error({key: value for key, value in payload.items() if key != 'init_images'})
+                    logger.error(body)
+                    logger.error(response)
+                    if 400 <= response.status < 500:
+                        raise backends.RequestRejected("{} rejected the request with {}".format(backend.url, response.status))
+                    raise GenerationError("{} failed with {}".format(backend.url, response.status))
+        except asyncio.TimeoutError:
+            raise backends.BackendTimeout("{} did not answer within {:.0f}s".format(backend.url, timeout)) from None
+        except aiohttp.ClientError as ex:
+            raise GenerationError("Could not reach {}: {}".format(backend.url, ex)) from ex
+        finally:
+            if polling is not None:
+                polling.cancel()
+
+        images, r = await run_render(functools.partial(decode_response, body))
+        del body
+
+        if len(images) < count:
+            raise GenerationError("{} sent {} images for {} requested".format(backend.url, len(images), count))
+
+    return images, r
+
+
+@dataclasses.dataclass(frozen=True)
+class Progress:
+    fraction: float
+    eta: Optional[float]
+    preview: Optional[bytes] = None
+
+
+class ProgressFeed:
+    """Progress of one generation, as an async iterator of its newest Progress.
+
+    Updates that arrive faster than they are consumed are coalesced, so a slow
+    consumer only ever sees the latest state. Iteration ends once the
+    generation is over, whether it succeeded or not.
+    """
+
+    def __init__(self, previews: bool = False) -> None:
+        self.previews = previews
+        self.latest: Optional[Progress] = None
+        self.closed = False
+        self._changed = asyncio.Event()
+
+    def publish(self, progress: Progress) -> None:
+        if not self.closed:
+            self.latest = progress
+            self._changed.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self._changed.set()
+
+    async def __aiter__(self) -> AsyncIterator[Progress]:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            if self.closed:
+                return
+            if self.latest is not None:
+                yield self.latest
+
+
+async def poll_progress(http_client: aiohttp.ClientSession, backend: backends.Backend, task_id: str, feeds: list[ProgressFeed]) -> None:
+    """Publish the progress of the backend call tagged with task_id to feeds until cancelled.
+
+    The backend's task endpoint reports on that call alone, and nothing is
+    published while the call is queued behind others. Backends without it only
+    report on whatever they run at the moment, so their progress is only used
+    while this is the one call in flight to that backend.
+    """
+    previews = any(feed.previews for feed in feeds)
+    timeout = aiohttp.ClientTimeout(total=config.progress_interval * 4)
+    tracked = True
+    preview_id = -1
+    preview = None
+    while True:
+        await asyncio.sleep(config.progress_interval)
+        try:
+            if tracked:
+                request = http_client.post(
+                    f'{backend.url}/internal/progress',
+                    json=dict(id_task=task_id, id_live_preview=preview_id, live_preview=previews),
+                    headers=backend.headers,
+                    timeout=timeout,
+                )
+            else:
+                request = http_client.get(
+                    f'{backend.url}/sdapi/v1/progress',
+                    params={'skip_current_image': 'false' if previews else 'true'},
+                    headers=backend.headers,
+                    timeout=timeout,
+                )
+            async with request as response:
+                if tracked and response.status == 404:
+                    logger.info("{} cannot report progress by task, falling back to its overall progress".format(backend.url))
+                    tracked = False
+                    continue
+                state = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+            logger.debug("Progress poll failed: {}".format(ex))
+            continue
+
+        if tracked:
+            if not state.get('active'):
+                continue
+            eta = state.get('eta')
+            if previews and state.get('live_preview'):
+                # Only sent when newer than preview_id, so the last one is kept until then
+                preview = base64.b64decode(_strip_data_url(state['live_preview'].encode()))
+                preview_id = state.get('id_live_preview', preview_id)
+        else:
+            if backend.in_flight != 1:
+                continue
+            eta = state.get('eta_relative')
+            preview = None
+            if previews and state.get('current_image'):
+                preview = base64.b64decode(_strip_data_url(state['current_image'].encode()))
+
+        fraction = float(state.get('progress') or 0.0)
+        for feed in feeds:
+            feed.publish(Progress(fraction=fraction, eta=eta, preview=preview if feed.previews else None))
+
+
+_IMAGES_KEY = re.compile(rb'"images"\s*:\s*\[')
+_WHITESPACE = b' \t\r\n'
+# How far into the body the images key is looked for, backends put it first
+_IMAGES_KEY_REACH = 64 * 1024
+
+
+def decode_response(body: bytes) -> tuple[list[bytes], dict[str, Any]]:
+    """Split a txt2img/img2img response body into decoded images and everything else.
+
+    The base64 images are located in the raw body and decoded straight from a
+    memoryview of it, so neither a parsed copy of the images nor their base64
+    text is ever built. Only the rest of the response goes through json.
+
+    Takes tens of milliseconds for a big image, so it belongs in run_render.
+    """
+    try:
+        spans, array_start, array_end = _image_spans(body)
+        view = memoryview(body)
+        images = [binascii.a2b_base64(_strip_data_url(view[start:end])) for start, end in spans]
+        r = json.loads(body[:array_start] + b'[]' + body[array_end:])
+    except (ValueError, IndexError):
+        # Escapes, truncation, bad base64 or anything else unexpected, take the slow path
+        r = json.loads(body)
+        images = r.pop("images", None) or []
+        return [base64.b64decode(_strip_data_url(data.encode())) for data in images], r
+
+    r.pop("images", None)
+    return images, r
+
+
+def _top_level_images(body: bytes) -> re.Match:
+    """The images key of the response object itself, skipping any nested or quoted one before it."""
+    depth = 0
+    in_string = escaped = False
+    pos = 0
+    for match in _IMAGES_KEY.finditer(body, 0, _IMAGES_KEY_REACH):
+        for byte in body[pos:match.start()]:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif byte == ord('\\'):
+                    escaped = True
+                elif byte == ord('"'):
+                    in_string = False
+            elif byte == ord('"'):
+                in_string = True
+            elif byte in b'{[':
+                depth += 1
+            elif byte in b'}]':
+                depth -= 1
+        pos = match.start()
+        if depth == 1 and not in_string:
+            return match
+    raise ValueError("no top level images in response")
+
+
+def _image_spans(body: bytes) -> tuple[list[tuple[int, int]], int, int]:
+    match = _top_level_images(body)
+
+    spans = []
+    pos = match.end()
+    while True:
+        while body[pos] in _WHITESPACE:
+            pos += 1
+        if body[pos] == ord(']'):
+            return spans, match.end() - 1, pos + 1
+        if body[pos] != ord('"'):
+            raise ValueError("unexpected image entry at {}".format(pos))
+
+        end = body.index(b'"', pos + 1)
+        if body.find(b'\\', pos + 1, end) != -1:
+            raise ValueError("escaped image entry at {}".format(pos))
+        spans.append((pos + 1, end))
+
+        pos = end + 1
+        while body[pos] in _WHITESPACE:
+            pos += 1
+        if body[pos] == ord(','):
+            pos += 1
+
+
+def _strip_data_url(data):
+    # Some backends send data URLs, the base64 starts after the comma
+    if bytes(data[:5]) == b'data:':
+        return data[bytes(data[:100]).index(b',') + 1:]
+    return data
+
+
+_render_executor: Optional[concurrent.futures.Executor] = None
+
+
+def get_render_executor() -> Optional[concurrent.futures.Executor]:
+    """The pool render_image runs in, per render_executor in the config, or None to render inline."""
+    global _render_executor
+    if _render_executor is None and config.render_executor != 'inline':
+        if config.render_executor == 'process':
+            _render_executor = concurrent.futures.ProcessPoolExecutor(max_workers=config.render_workers)
+        else:
+            _render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.render_workers, thread_name_prefix='render')
+    return _render_executor
+
+
+def shutdown_render_executor() -> None:
+    global _render_executor
+    if _render_executor is not None:
+        _render_executor.shutdown(wait=False, cancel_futures=True)
+        _render_executor = None
+
+
+async def run_render(render: functools.partial) -> Any:
+    executor = get_render_executor()
+    if executor is None:
+        return render()
+    return await asyncio.get_running_loop().run_in_executor(executor, render)
+
+
+def render_image(
+        raw_image: bytes,
+        prompt: str,
+        width: int,
+        height: int,
+        overlay: bool = True,
+        suppress_description: bool = False,
+        resize_dimensions: Optional[tuple[int, int]] = None,
+        palette: Optional[str] = None,
+        format: Optional[str] = None,
+        quantizer: str = 'pil',
+        resample: Optional[str] = None,
+        reducing_gap: Optional[float] = None,
+) -> tuple[bytes, str]:
+    """Apply the palette, resizing, overlay and encoding to a decoded backend image.
+
+    Pure and picklable both ways, so it can run in another process. Returns the
+    encoded image and its file name.
+
+    A palette image can only be resized by picking pixels, so when a resample
+    filter is asked for the image is resized before the palette is applied.
+    """
+    image_hash = sha512(raw_image).hexdigest()
+    image_bytes = io.BytesIO(raw_image)
+
+    working_image = Image.open(image_bytes)
+
+    resize_first = resize_dimensions is not None and resample is not None
+    if resize_first:
+        logger.info("Resizing to {} with {}".format(resize_dimensions, resample))
+        working_image = image.resize(working_image, resize_dimensions, resample, reducing_gap)
+
+    if palette is not None:
+        for filter in [EDGE_ENHANCE]:
+            working_image = working_image.filter(filter)
+
+        for enhancement, level in (
+            (Brightness, 1.1),
+            (Color, 1.1),
+            (Sharpness, 2),
+            (Contrast, 1.6),
+        ):
+            enhancer = enhancement(working_image)
+            working_image = enhancer.enhance(level)
+
+        working_image = image.quantize(working_image, palette, quantizer)
+
+    if resize_dimensions is not None and not resize_first:
+        logger.info("Resizing to {}".format(resize_dimensions))
+        working_image = image.resize(working_image, resize_dimensions, reducing_gap=reducing_gap)
+
+    if overlay:
+        title, desc = prompt_to_overlay(prompt)
+        if suppress_description:
+            desc = None
 
-            if resize_dimensions is not None:
-                width, height = resize_dimensions
+        if resize_dimensions is not None:
+            width, height = resize_dimensions
 
-            image.add_text_to_image(working_image, height, width, title, desc)
+        image.draw_overlay(working_image, height, width, title, desc)
 
-        buf = io.BytesIO()
-        if not format:
-            format = 'PNG'
+    buf = io.BytesIO()
+    if not format:
+        format = 'PNG'
 
-        if format == 'JPEG' or format == 'JPG':
-            if working_image.mode != 'RGB':
-                working_image = working_image.convert('RGB')
+    if format == 'JPEG' or format == 'JPG':
+        if working_image.mode != 'RGB':
+            working_image = working_image.convert('RGB')
 
-        working_image.save(buf, format=format)
-        buf.seek(0)
+    working_image.save(buf, format=format)
 
-        base_name = re.sub(r'[^\w\d]+', '-', prompt)
-        return File(fp=buf, filename="{}-{}.png".format(base_name, image_hash[0:6]), description=prompt, spoiler=spoiler), reprompt_struct
+    base_name = re.sub(r'[^\w\d]+', '-', prompt)
+    return buf.getvalue(), "{}-{}.png".format(base_name, image_hash[0:6])
@@ -1,12 +1,97 @@
-import re
+import dataclasses
+import hashlib
+import logging
+import os
+import pickle
 import random
+import re
+import time
+import tracemalloc
+import tempfile
+import threading
+from bisect import bisect_left
+from functools import cached_property
+from typing import Optional
+
+import numpy as np
+
+from stabby import conf
+
+
+DEFAULT_MAX_DEPTH = 32
+DEFAULT_MAX_TOKENS = 128
+# Below this many sentences, numpy call overhead outweighs what the vectorized expansion saves
+BATCH_THRESHOLD = 32
+# Bump whenever the compiled layout changes, so stale caches are parsed again instead of loaded
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.grammar-cache'
+# How many extra samples to draw when an output was recently produced, before repeating it anyway
+RECENT_RETRIES = 5
+
+logger = logging.getLogger('discord.stabby.grammar')
+
+
+@dataclasses.dataclass(frozen=True)
+class BatchTables:
+    """Integer encoding of the compiled grammar, for expanding many sentences at once with numpy.
+
+    Symbols are numbered with the non-terminals first. Every symbol has a production:
+    the grammar's productions come first (grouped by non-terminal, in probability order),
+    then one empty production, then an identity production for each terminal.
+    """
+    symbols: np.ndarray  # symbol id -> text
+    symbol_ids: dict[str, int]
+    non_terminals: int
+    keys: np.ndarray  # 2 * symbol id + cumulative probability, sorted, one per grammar production
+    key_end: np.ndarray  # non-terminal id -> end of its run in keys
+    empty: int
+    identity: np.ndarray  # symbol id -> production id, identity for terminals
+    fallback: np.ndarray  # non-terminal id -> cheapest production id
+    production_start: np.ndarray
+    production_length: np.ndarray
+    production_symbols: np.ndarray
+
+
+@dataclasses.dataclass
+class SymbolAnalysis:
+    start: str
+    # Average number of non-terminal expansions in one derivation, infinite if derivations can run away
+    expected_expansions: float
+    # Average number of terminal tokens produced, ignoring depth and token limits
+    expected_length: float
+    # Chance a derivation reaches max_depth and gets cut short by the cheapest-production fallback
+    depth_limit_probability: float
+    max_depth: int
+
+
+@dataclasses.dataclass
+class GrammarAnalysis:
+    symbols: list[SymbolAnalysis]
+    # Non-terminals that none of the analyzed start symbols can reach
+    unreachable: list[str]
+    # Terminals that look like a non-terminal name with no rules, most likely a typo or a missing rule
+    undefined: list[str]
+
+
+@dataclasses.dataclass
+class GrammarBenchmark:
+    start: str
+    count: int
+    prompts_per_second: float
+    # Peak traced memory while generating one prompt, from tracemalloc
+    peak_bytes_per_prompt: float
+    batched: bool
+
+
+# Non-terminals in the shipped grammars are named like QUALITY_MOD, or NP and Subject
+SYMBOL_LIKE = re.compile(r'[A-Z][A-Z0-9]*(?:_[A-Z0-9]+)+')
 
 
 class Grammar():
-    def __init__(self, grammar_definition) -> None:
-        grammar = open(grammar_definition)
+    def __init__(self, grammar_definition, max_depth: int = DEFAULT_MAX_DEPTH, max_tokens: int = DEFAULT_MAX_TOKENS) -> None:
+        with open(grammar_definition) as grammar:
+            lines = grammar.readlines()
 
-        lines = grammar.readlines()
         rules = []
         non_terminal: dict = {}  # stores total of odds of non-terminal symbol which is the key
         for line in lines:
@@ -24,42 +109,598 @@ class Grammar():
                 else:
                     non_terminal[l_tokens[1]] += float(l_tokens[0])
 
-        self.rules = rules
+        self.rules = tuple(tuple(rule) for rule in rules)
         self.non_terminal = non_terminal
+        self.productions = self._compile(rules, non_terminal)
+        self.fallbacks = self._cheapest_productions(self.productions)
+        self.max_depth = max_depth
+        self.max_tokens = max_tokens
+
+    @classmethod
+    def load(
+            cls,
+            grammar_definition,
+            cache_dir: Optional[str] = None,
+            max_depth: int = DEFAULT_MAX_DEPTH,
+            max_tokens: int = DEFAULT_MAX_TOKENS,
+    ) -> 'Grammar':
+        """Load a grammar through its on-disk compiled cache, only parsing the text when it has changed.
+
+        The cache lives next to the grammar file, or in cache_dir when one is given. It is keyed
+        on the source path, mtime and size, and falls back to comparing a content hash when the
+        mtime moved, so a fresh checkout of an unchanged file still hits the cache.
+        """
+        path = os.path.abspath(grammar_definition)
+        cache_path = _cache_path(path, cache_dir)
+        stat = os.stat(path)
+        key = dict(version=CACHE_VERSION, path=path, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+        digest = None
+        try:
+            with open(cache_path, 'rb') as cache:
+                header = pickle.load(cache)
+                if header.get('version') == CACHE_VERSION and header.get('path') == path:
+                    if {field: header.get(field) for field in key} != key:
+                        digest = _file_digest(path)
+                    if digest is None or digest == header.get('sha256'):
+                        language = pickle.load(cache)
+                        language.max_depth = max_depth
+                        language.max_tokens = max_tokens
+                        if digest is not None:
+                            _write_cache(cache_path, dict(key, sha256=digest), language)
+                        return language
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            logger.warning("Ignoring unreadable grammar cache {}: {}".format(cache_path, ex))
+
+        logger.info("Compiling grammar {}".format(path))
+        language = cls(path, max_depth=max_depth, max_tokens=max_tokens)
+        # Build the batch tables now so they are part of what gets cached
+        language.batch_tables
+        _write_cache(cache_path, dict(key, sha256=digest or _file_digest(path)), language)
+        return language
+
+    @staticmethod
+    def _compile(rules, non_terminal) -> dict[str, tuple[tuple[float, ...], tuple[tuple[str, ...], ...]]]:
+        # Group the rules by non-terminal into a sorted table of cumulative
+        # probabilities, so picking a production is a bisect rather than a scan.
+        # The table is built exactly the way the per-expansion scan used to build
+        # it, which keeps the chosen production for any given random draw the same.
+        rand_counts: dict[str, dict[float, tuple[str, ...]]] = {}
+        current_counts: dict[str, float] = {}
+        for rule in rules:
+            symbol = rule[1]
+            current_count = current_counts.get(symbol, 0.0) + float(rule[0]) / float(non_terminal[symbol])
+            current_counts[symbol] = current_count
+            rand_counts.setdefault(symbol, {})[current_count] = tuple(rule[2:])
+
+        productions = {}
+        for symbol, rand_count in rand_counts.items():
+            probabilities = tuple(sorted(rand_count.keys()))
+            productions[symbol] = (probabilities, tuple(rand_count[prob] for prob in probabilities))
+
+        return productions
+
+    @staticmethod
+    def _cheapest_productions(productions) -> dict[str, tuple[str, ...]]:
+        # For every non-terminal, find the production that terminates with the fewest tokens.
+        # This is what expansion falls back to once a depth or token limit has been hit.
+        # Symbols that can never terminate are left out, and expand to nothing when forced.
+        costs: dict[str, float] = {}
+        fallbacks: dict[str, tuple[str, ...]] = {}
+        changed = True
+        while changed:
+            changed = False
+            for symbol, (_, expansions) in productions.items():
+                for expansion in expansions:
+                    cost = sum(costs.get(s, float('inf')) if s in productions else 1 for s in expansion)
+                    if cost < costs.get(symbol, float('inf')):
+                        costs[symbol] = cost
+                        fallbacks[symbol] = expansion
+                        changed = True
 
-    def _sentence_generator(self, symbol, sentence) -> None:
-        rand_count = {}  # stores rule as value, key is the cumulative probability of the rule
-        # for writing tree structure
-        # base case
-        if symbol not in self.non_terminal.keys():
-            sentence.append(symbol)
+        return fallbacks
+
+    @cached_property
+    def batch_tables(self) -> BatchTables:
+        symbols = list(self.productions.keys())
+        symbol_ids = {symbol: idx for idx, symbol in enumerate(symbols)}
+        for _, expansions in self.productions.values():
+            for expansion in expansions:
+                for symbol in expansion:
+                    if symbol not in symbol_ids:
+                        symbol_ids[symbol] = len(symbols)
+                        symbols.append(symbol)
+        non_terminals = len(self.productions)
+
+        keys = []
+        key_end = []
+        productions = []
+        production_ids = {}
+        for symbol_id, (probabilities, expansions) in enumerate(self.productions.values()):
+            for probability, expansion in zip(probabilities, expansions):
+                keys.append(2 * symbol_id + probability)
+                production_ids[symbol_id, expansion] = len(productions)
+                productions.append([symbol_ids[s] for s in expansion])
+            key_end.append(len(keys))
+
+        empty = len(productions)
+        productions.append([])
+        identity = np.full(len(symbols), empty)
+        for symbol_id in range(non_terminals, len(symbols)):
+            identity[symbol_id] = len(productions)
+            productions.append([symbol_id])
+
+        fallback = np.array([
+            production_ids.get((symbol_id, self.fallbacks.get(symbol)), empty)
+            for symbol_id, symbol in enumerate(symbols[:non_terminals])
+        ], dtype=np.intp)
+
+        production_length = np.array([len(production) for production in productions], dtype=np.intp)
+        production_start = np.cumsum(production_length) - production_length
+
+        return BatchTables(
+            symbols=np.array(symbols, dtype=object),
+            symbol_ids=symbol_ids,
+            non_terminals=non_terminals,
+            keys=np.array(keys, dtype=np.float64),
+            key_end=np.array(key_end, dtype=np.intp),
+            empty=empty,
+            identity=identity,
+            fallback=fallback,
+            production_start=production_start,
+            production_length=production_length,
+            production_symbols=np.array([s for production in productions for s in production], dtype=np.intp),
+        )
+
+    def root_symbols(self) -> list[str]:
+        # Start symbols are the ones no other symbol expands into, though they may recurse on themselves
+        referenced = {
+            child
+            for symbol, (_, expansions) in self.productions.items()
+            for expansion in expansions
+            for child in expansion
+            if child != symbol
+        }
+        return [symbol for symbol in self.productions if symbol not in referenced]
+
+    def analyze(self, starts: Optional[list[str]] = None, max_depth: Optional[int] = None) -> GrammarAnalysis:
+        """Statically estimate the cost of generating from each start symbol.
+
+        Expected counts come from the expected-occurrence matrix of the grammar,
+        M[a, b] being how many times b appears on average in one expansion of a.
+        Expansions solve E = 1 + M E and lengths solve L = t + M L over the
+        symbols reachable from each start; both are infinite when that part of
+        M has spectral radius of at least one.
+        """
+        if starts is None:
+            starts = self.root_symbols()
+        if max_depth is None:
+            max_depth = self.max_depth
+
+        symbols = list(self.productions)
+        ids = {symbol: idx for idx, symbol in enumerate(symbols)}
+        occurrences = np.zeros((len(symbols), len(symbols)))
+        terminals = np.zeros(len(symbols))
+        for symbol, (probabilities, expansions) in self.productions.items():
+            previous = 0.0
+            for probability, expansion in zip(probabilities, expansions):
+                weight = probability - previous
+                previous = probability
+                for child in expansion:
+                    if child in ids:
+                        occurrences[ids[symbol], ids[child]] += weight
+                    else:
+                        terminals[ids[symbol]] += weight
+
+        within_depth = self._within_depth_probabilities(max_depth)
+
+        results = []
+        reachable: set[str] = set()
+        for start in starts:
+            if start not in ids:
+                results.append(SymbolAnalysis(start, 0.0, 1.0, 0.0, max_depth))
+                continue
+
+            # Solve over only the symbols this start can reach, so a runaway symbol
+            # elsewhere in the grammar does not make every start look infinite
+            from_start = self._reachable(start)
+            reachable |= from_start
+            sub = [ids[symbol] for symbol in symbols if symbol in from_start]
+            local = occurrences[np.ix_(sub, sub)]
+            own = sub.index(ids[start])
+
+            radius = max(abs(np.linalg.eigvals(local)), default=0.0)
+            if radius < 1:
+                fundamental = np.linalg.inv(np.eye(len(sub)) - local)
+                expected_expansions = float(fundamental[own].sum())
+                expected_length = float(fundamental[own] @ terminals[sub])
+            else:
+                expected_expansions = expected_length = float('inf')
+
+            results.append(SymbolAnalysis(
+                start=start,
+                expected_expansions=expected_expansions,
+                expected_length=expected_length,
+                depth_limit_probability=max(0.0, 1.0 - within_depth[start]),
+                max_depth=max_depth,
+            ))
+
+        upper_symbols = {symbol.upper() for symbol in symbols}
+        undefined = sorted({
+            child
+            for symbol in reachable
+            for expansion in self.productions[symbol][1]
+            for child in expansion
+            if child not in ids and (SYMBOL_LIKE.fullmatch(child) or (child.upper() in upper_symbols and not child.islower()))
+        })
+
+        return GrammarAnalysis(
+            symbols=results,
+            unreachable=[symbol for symbol in symbols if symbol not in reachable],
+            undefined=undefined,
+        )
+
+    def _reachable(self, start: str) -> set[str]:
+        reachable = set()
+        pending = [start]
+        while pending:
+            symbol = pending.pop()
+            if symbol in reachable:
+                continue
+            reachable.add(symbol)
+            pending.extend(child for expansion in self.productions[symbol][1] for child in expansion if child in self.productions)
+        return reachable
+
+    def _within_depth_probabilities(self, max_depth: int) -> dict[str, float]:
+        # within[symbol] after k rounds is the chance a derivation from symbol never puts a
+        # non-terminal k levels below it, which is exactly when expansion stays under the limit
+        within = dict.fromkeys(self.productions, 0.0)
+        for _ in range(max_depth):
+            updated = {}
+            for symbol, (probabilities, expansions) in self.productions.items():
+                total = 0.0
+                previous = 0.0
+                for probability, expansion in zip(probabilities, expansions):
+                    chance = probability - previous
+                    previous = probability
+                    for child in expansion:
+                        chance *= within.get(child, 1.0)
+                    total += chance
+                # Draws past the last cumulative probability expand to nothing, which also terminates
+                updated[symbol] = total + max(0.0, 1.0 - previous)
+            within = updated
+        return within
+
+    def benchmark(self, start='ROOT', count: int = 1000, batched: bool = False) -> GrammarBenchmark:
+        began = time.perf_counter()
+        if batched:
+            self.generate_many(count, start=start)
         else:
-            total_count = float(self.non_terminal[symbol])
-            current_count = 0.0
-            # find all rules applicable for given non-terminal symbol
-            for rule in self.rules:
-                if rule[1] == symbol:
-                    current_count = current_count + float(rule[0]) / total_count
-                    rand_count[current_count] = rule
-            r = random.random()
-            apply_rule = []
-            # select rule according to the number generated and probabilities calculated
-            for prob in sorted(rand_count.keys()):
-                if prob >= r:
-                    apply_rule = rand_count[prob]
-                    break
-            for s in apply_rule[2:len(apply_rule)]:
-                # extra space for bracket
-                self._sentence_generator(s, sentence)
-
-    def generate(self, start='ROOT') -> str:
-        sentence: list = []
-        self._sentence_generator(start, sentence)
-        text = ' '.join(sentence)
-        text = re.sub(r',(\s*,)+', ',', text)
-        text = re.sub(r'[,]+', ',', text)
-        text = re.sub(r'([\[({])\s+', r'\1', text)
-        text = re.sub(r'\s+([\])},])', r'\1', text)
-        text = re.sub(r'([\w\d])\s+([^\w\d])', r'\1\2', text)
-        text = re.sub(r'[ ]+', ' ', text)
+            for _ in range(count):
+                self.generate(start=start)
+        elapsed = time.perf_counter() - began
+
+        samples = min(count, 100)
+        rounds = 1 if batched else samples
+        peak = 0
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            for _ in range(rounds):
+                tracemalloc.reset_peak()
+                baseline, _ = tracemalloc.get_traced_memory()
+                if batched:
+                    self.generate_many(samples, start=start)
+                else:
+                    self.generate(start=start)
+                _, sample_peak = tracemalloc.get_traced_memory()
+                peak += sample_peak - baseline
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+        return GrammarBenchmark(
+            start=start,
+            count=count,
+            prompts_per_second=count / elapsed if elapsed else float('inf'),
+            peak_bytes_per_prompt=peak / samples if samples else 0.0,
+            batched=batched,
+        )
+
+    def _sentence_generator(self, symbol, sentence, rand=random.random, max_depth=None, max_tokens=None) -> None:
+        if max_depth is None:
+            max_depth = self.max_depth
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+
+        # Expand depth first with an explicit stack, so symbols come out (and random numbers
+        # are drawn) in the same left to right order as a recursive walk would.
+        stack = [(symbol, 0)]
+        while stack:
+            symbol, depth = stack.pop()
+            production = self.productions.get(symbol)
+            # base case
+            if production is None:
+                sentence.append(symbol)
+                continue
+
+            if depth >= max_depth or len(sentence) >= max_tokens:
+                expansion = self.fallbacks.get(symbol, ())
+            else:
+                probabilities, expansions = production
+                # select rule according to the number generated and probabilities calculated
+                index = bisect_left(probabilities, rand())
+                if index >= len(expansions):
+                    continue
+                expansion = expansions[index]
+
+            stack.extend((s, depth + 1) for s in reversed(expansion))
+
+    def generate(
+            self,
+            start='ROOT',
+            max_depth: Optional[int] = None,
+            max_tokens: Optional[int] = None,
+            recent: Optional['RecentFilter'] = None,
+            retries: int = RECENT_RETRIES,
+    ) -> str:
+        for _ in range(retries + 1):
+            sentence: list = []
+            self._sentence_generator(start, sentence, max_depth=max_depth, max_tokens=max_tokens)
+            text = self._join(sentence)
+            if recent is None or recent.admit(text):
+                break
         return text
+
+    def generate_many(
+            self,
+            n: int,
+            start='ROOT',
+            seed=None,
+            max_depth: Optional[int] = None,
+            max_tokens: Optional[int] = None,
+    ) -> list[str]:
+        """Generate n sentences together, one derivation level at a time.
+
+        Every non-terminal in the batch is expanded in the same step, with its
+        uniforms drawn as one numpy array and looked up in the cumulative tables
+        with a single searchsorted, so the Python work per prompt is only the final join.
+        The token budget here counts every symbol of a partial sentence, not only
+        the terminals to the left of the one being expanded.
+        """
+        if max_depth is None:
+            max_depth = self.max_depth
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+
+        if n < BATCH_THRESHOLD:
+            rand = random.Random(seed).random
+            sentences = []
+            for _ in range(n):
+                sentence: list = []
+                self._sentence_generator(start, sentence, rand=rand, max_depth=max_depth, max_tokens=max_tokens)
+                sentences.append(self._join(sentence))
+            return sentences
+
+        tables = self.batch_tables
+        if start not in tables.symbol_ids:
+            return [self._join([start]) for _ in range(n)]
+
+        rng = np.random.default_rng(seed)
+        sequence = np.full(n, tables.symbol_ids[start], dtype=np.intp)
+        owner = np.arange(n, dtype=np.intp)
+        depth = np.zeros(n, dtype=np.intp)
+
+        while True:
+            pending = np.flatnonzero(sequence < tables.non_terminals)
+            if not len(pending):
+                break
+
+            symbols = sequence[pending]
+            index = np.searchsorted(tables.keys, 2 * symbols + rng.random(len(pending)), side='left')
+            chosen = np.where(
+                index < tables.key_end[symbols],
+                np.minimum(index, len(tables.keys) - 1),
+                tables.empty,
+            )
+
+            lengths = np.bincount(owner, minlength=n)
+            limited = (depth[pending] >= max_depth) | (lengths[owner[pending]] >= max_tokens)
+            chosen[limited] = tables.fallback[symbols[limited]]
+
+            productions = tables.identity[sequence]
+            productions[pending] = chosen
+
+            # Splice every production into place with one ragged gather
+            counts = tables.production_length[productions]
+            offsets = np.cumsum(counts) - counts
+            gather = np.repeat(tables.production_start[productions] - offsets, counts) + np.arange(counts.sum())
+
+            deeper = depth.copy()
+            deeper[pending] += 1
+
+            sequence = tables.production_symbols[gather]
+            owner = np.repeat(owner, counts)
+            depth = np.repeat(deeper, counts)
+
+        words = tables.symbols[sequence].tolist()
+        counts = np.bincount(owner, minlength=n)
+        bounds = np.cumsum(counts).tolist()
+        return [self._join(words[end - count:end]) for end, count in zip(bounds, counts.tolist())]
+
+    @staticmethod
+    def _join(sentence) -> str:
+        # Joins the tokens with spaces in one pass, tidying punctuation as it goes:
+        # runs of commas collapse to one, and no space is left after an opening
+        # bracket, before a closing bracket or comma, or between a word character
+        # and anything else. Tokens come from str.split(), so never hold whitespace.
+        parts: list[str] = []
+        prev = ''
+        for token in sentence:
+            space = True
+            if prev == ',' and token[0] == ',':
+                # The comma run spans the space between tokens, so both collapse
+                token = token.lstrip(',')
+                if not token:
+                    continue
+                space = False
+            while ',,' in token:
+                token = token.replace(',,', ',')
+
+            if parts and space:
+                first = token[0]
+                if not (prev in _OPENING or first in _CLOSING or (_is_word(prev) and not _is_word(first))):
+                    parts.append(' ')
+            parts.append(token)
+            prev = token[-1]
+
+        return ''.join(parts)
+
+
+def load_grammar(grammar_definition, config: conf.Conf) -> Grammar:
+    return Grammar.load(
+        grammar_definition,
+        cache_dir=config.grammar_cache_dir,
+        max_depth=config.grammar_max_depth,
+        max_tokens=config.grammar_max_tokens,
+    )
+
+
+class RecentFilter:
+    """Fixed size memory of recently produced outputs, for avoiding repeats.
+
+    Keeps the hashes of the last `size` admitted outputs in a ring buffer, with
+    a counting dict over it for O(1) membership checks.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._ring: list[Optional[int]] = [None] * size
+        self._counts: dict[int, int] = {}
+        self._next = 0
+        self.checks = 0
+        self.hits = 0
+
+    def __contains__(self, text: str) -> bool:
+        return hash(text) in self._counts
+
+    def add(self, text: str) -> None:
+        if not self.size:
+            return
+
+        key = hash(text)
+        evicted = self._ring[self._next]
+        if evicted is not None:
+            remaining = self._counts[evicted] - 1
+            if remaining:
+                self._counts[evicted] = remaining
+            else:
+                del self._counts[evicted]
+
+        self._ring[self._next] = key
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self._next = (self._next + 1) % self.size
+
+    def admit(self, text: str) -> bool:
+        """Record text as produced unless it was produced recently, in which case it is rejected."""
+        self.checks += 1
+        if text in self:
+            self.hits += 1
+            return False
+
+        self.add(text)
+        return True
+
+
+_OPENING = frozenset('[({')
+_CLOSING = frozenset('])},')
+
+
+def _is_word(char: str) -> bool:
+    # Same as the \w class for str patterns in re
+    return char.isalnum() or char == '_'
+
+
+class GrammarRegistry:
+    """Hands out one shared compiled Grammar per configured grammar file.
+
+    Grammars are loaded on first use. A reload compiles the replacements before
+    swapping them in, so callers only ever see a complete old or new grammar.
+    Grammars from the registry are shared and must be treated as read only.
+    """
+
+    def __init__(self, config: conf.Conf) -> None:
+        self._config = config
+        self._grammars: dict[str, Grammar] = {}
+        self._lock = threading.Lock()
+
+    def sources(self) -> dict[str, str]:
+        return dict(
+            karma=self._config.karma_grammar,
+            prompt=self._config.prompt_grammar,
+            maker=self._config.maker_grammar,
+        )
+
+    def get(self, name: str) -> Grammar:
+        language = self._grammars.get(name)
+        if language is None:
+            with self._lock:
+                language = self._grammars.get(name)
+                if language is None:
+                    language = load_grammar(self.sources()[name], self._config)
+                    self._grammars = {**self._grammars, name: language}
+        return language
+
+    def reload(self, name: Optional[str] = None) -> list[str]:
+        names = [name] if name is not None else list(self.sources())
+        with self._lock:
+            replacements = {
+                reload_name: load_grammar(self.sources()[reload_name], self._config)
+                for reload_name in names
+            }
+            self._grammars = {**self._grammars, **replacements}
+        return names
+
+
+_registry: Optional[GrammarRegistry] = None
+
+
+def get_registry() -> GrammarRegistry:
+    global _registry
+    if _registry is None:
+        _registry = GrammarRegistry(conf.load_conf())
+    return _registry
+
+
+def _cache_path(path: str, cache_dir: Optional[str]) -> str:
+    if cache_dir is None:
+        return path + CACHE_SUFFIX
+
+    path_hash = hashlib.sha1(path.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}-{}{}'.format(path_hash, os.path.basename(path), CACHE_SUFFIX))
+
+
+def _file_digest(path: str) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _write_cache(cache_path: str, header: dict, language: Grammar) -> None:
+    # Written to a temporary file and renamed into place, so a concurrent reader never sees half a cache
+    try:
+        directory = os.path.dirname(cache_path)
+        os.makedirs(directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as cache:
+                pickle.dump(header, cache, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(language, cache, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except Exception as ex:
+        logger.warning("Could not write grammar cache {}: {}".format(cache_path, ex))
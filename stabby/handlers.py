@@ -1,6 +1,6 @@
 import io
+import json
 import logging
-import re
 
 from typing import Any, cast
 from datetime import datetime, timezone
@@ -8,14 +8,16 @@ from datetime import datetime, timezone
 from quart import Quart, request, send_file
 from quart.json.provider import DefaultJSONProvider
 
-import stabby
-
-from stabby import grammar
+from stabby import backends
 from stabby import conf
-from stabby import text_utils
+from stabby import generation
+from stabby import grammar
+from stabby import inputs
+from stabby import jobs
+from stabby import prompts
+from stabby import result_cache
 from stabby.schema import StabbyTable
-from stabby.generation import generate_ai_image
-from stabby.image import get_closest_dimensions
+from stabby.image import QUANTIZERS, RESAMPLING, get_closest_dimensions
 
 config = conf.load_conf()
 
@@ -43,47 +45,6 @@ class ModelProvider(DefaultJSONProvider):
 app = Quart("StabbyDiscoBot")
 app.json = ModelProvider(app)
 
-maker_grammar = grammar.Grammar(config.maker_grammar)
-
-
-def make_random_prompt(args: dict) -> str:
-    params = dict(
-        quality=None,
-        subject=None,
-        action=None,
-        environment=None,
-        object=None,
-        color=None,
-        style=None,
-        mood=None,
-        lighting=None,
-        perspective=None,
-        texture=None,
-        time_period=None,
-        cultural_elements=None,
-        emotion=None,
-        medium=None,
-    )
-
-    for arg in params:
-        passed = args.get(arg)
-        if passed is not None:
-            params[arg] = passed
-
-    prompt = text_utils.template_grammar_fill(params, maker_grammar, True)
-
-    prompt_text = ''
-    for joint_fields in [
-        ['subject', 'object', 'action'],
-        ['perspective', 'quality', 'medium', 'style'],
-    ]:
-        prompt_text += ' '.join([prompt.pop(field, '') for field in joint_fields])
-        prompt_text += ', '
-
-    prompt_text += ', '.join([v for v in prompt.values() if v])
-    prompt_text = re.sub(r'[ ]+', ' ', prompt_text)
-
-    return prompt_text
 
 @app.get("/api/generate")
 async def generate_image():
@@ -92,13 +53,31 @@ async def generate_image():
     height = int(request.args.get('h') or 1024)
     palette = request.args.get('palette')
     format = request.args.get('format')
-
-    prompt = request.args.get("prompt") or make_random_prompt(request.args)
+    quantizer = request.args.get('quantizer') or 'pil'
+    if quantizer not in QUANTIZERS:
+        return dict(error='quantizer must be one of {}'.format(', '.join(QUANTIZERS))), 400
+    resample = request.args.get('resample')
+    if resample is not None and resample not in RESAMPLING:
+        return dict(error='resample must be one of {}'.format(', '.join(RESAMPLING))), 400
+    reducing_gap = None
+    if request.args.get('reducing_gap'):
+        try:
+            reducing_gap = float(request.args['reducing_gap'])
+        except ValueError:
+            return dict(error='reducing_gap must be a number'), 400
+        if not reducing_gap >= 1.0:
+            return dict(error='reducing_gap must be at least 1'), 400
+
+    prompt = request.args.get("prompt")
+    if not prompt:
+        if any(request.args.get(field) is not None for field in prompts.MAKER_FIELDS):
+            prompt = prompts.make_random_prompt(request.args)
+        else:
+            prompt = prompts.get_pool().pop('maker:random')
 
     gen_width, gen_height = get_closest_dimensions(width=width, height=height)
 
-    file, _ = await generate_ai_image(
-        http_client=await stabby.get_http_client(),
+    params = dict(
         prompt=prompt,
         steps=20,
         width=gen_width,
@@ -107,9 +86,64 @@ async def generate_image():
         resize_dimensions=(width, height),
         palette=palette,
         format=format,
+        quantizer=quantizer,
+        resample=resample,
+        reducing_gap=reducing_gap,
     )
+    cached = await generation.cached_result(params)
+    if cached is not None:
+        file, _ = cached
+    else:
+        try:
+            job = jobs.get_queue().submit(params)
+        except jobs.QueueFull as ex:
+            return dict(error=str(ex)), 503, {'Retry-After': str(int(config.ratelimit_window))}
+
+        file, _ = await job
 
     return await send_file(
         cast(io.BytesIO, file.fp),
         mimetype='image/png',
     )
+
+
+@app.get("/api/prompts")
+async def generated_prompts():
+    name = request.args.get('grammar') or 'maker'
+    if name not in grammar.get_registry().sources():
+        return dict(error='Unknown grammar {}'.format(name)), 400
+
+    try:
+        count = int(request.args.get('n') or 1)
+    except ValueError:
+        return dict(error='n must be a number'), 400
+
+    if not 0 < count <= config.prompt_stream_max:
+        return dict(error='n must be between 1 and {}'.format(config.prompt_stream_max)), 400
+
+    start = request.args.get('start')
+    if start is not None and start not in grammar.get_registry().get(name).productions:
+        return dict(error='Unknown start symbol {} for grammar {}'.format(start, name)), 400
+
+    args = request.args.to_dict()
+    overrides = [field for field in prompts.MAKER_FIELDS if field in args]
+    if overrides and (name != 'maker' or start is not None):
+        return dict(error='{} only apply to maker prompts without a start symbol'.format(', '.join(overrides))), 400
+
+    async def lines():
+        async for chunk in prompts.stream_prompts(name, count, start=start, args=args):
+            yield ''.join(json.dumps(dict(prompt=prompt)) + '\n' for prompt in chunk).encode()
+
+    return lines(), 200, {'Content-Type': 'application/x-ndjson'}
+
+
+@app.get("/api/metrics")
+async def metrics():
+    return dict(
+        prompt_pool=prompts.get_pool().stats(),
+        recent_filter=prompts.get_recent_filters().stats(),
+        jobs=jobs.get_queue().stats(),
+        backends=backends.get_pool().stats(),
+        result_cache=result_cache.get_cache().stats(),
+        input_cache=inputs.get_cache().stats(),
+    )
@@ -1,18 +1,31 @@
+import collections
+import functools
 import itertools
 import math
 import io
 import base64
+import binascii
+import bisect
+import threading
 
 from typing import Optional
+import numpy as np
 from PIL import Image
+from PIL import ImageChops
 from PIL import ImageDraw
 from PIL import ImageFont
 from PIL import PngImagePlugin
 
-from stabby import conf
+from stabby import conf, lru
 config = conf.load_conf()
 
 
+# Pillow never releases the GIL while measuring or drawing text, so render threads can share fonts
+@functools.lru_cache(maxsize=64)
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, size=size)
+
+
 def add_text_to_image(
         image: Image.Image,
         image_height: int,
@@ -27,8 +40,8 @@ def add_text_to_image(
         artist_size=15) -> ImageDraw.ImageDraw:
     draw = ImageDraw.Draw(image)
 
-    title_font = ImageFont.truetype(config.title_font, size=title_size)
-    artist_font = ImageFont.truetype(config.artist_font, size=artist_size)
+    title_font = load_font(config.title_font, title_size)
+    artist_font = load_font(config.artist_font, artist_size)
     # proceed flag only to be set if set by prerequisite requirements
     proceed = False
 
@@ -54,11 +67,24 @@ def add_text_to_image(
 
     # Only draw if we previously set proceed flag
     if proceed is True:
-        while (title_box is None or title_box[0] < draw_box[0] or title_box[1] < draw_box[1]) and title_size > artist_size:
-            title_font = ImageFont.truetype(config.title_font, size=title_size)
-            title_box = draw.textbbox((image_width / 2, image_height - title_location),
-                                      title_text, font=title_font, anchor="mb")
-            title_size -= 1
+        def title_fits(size: int) -> bool:
+            box = draw.textbbox((image_width / 2, image_height - title_location),
+                                title_text, font=load_font(config.title_font, size), anchor="mb")
+            return box[0] >= draw_box[0] and box[1] >= draw_box[1]
+
+        if (title_box[0] < draw_box[0] or title_box[1] < draw_box[1]) and title_size > artist_size:
+            # Largest size above artist_size that fits, or the smallest of them if none does
+            low, high = artist_size + 1, title_size - 1
+            fitted = low
+            while low <= high:
+                middle = (low + high) // 2
+                if title_fits(middle):
+                    fitted, low = middle, middle + 1
+                else:
+                    high = middle - 1
+            title_font = load_font(config.title_font, fitted)
+            # The outline is sized one point smaller than the font, as it always has been
+            title_size = fitted - 1
 
         if opacity > 0 and image.has_transparency_data:
             draw.rectangle(draw_box, fill=(255, 255, 255, opacity))
@@ -121,47 +147,324 @@ def max_area(area_list):
     return tup
 
 
-ASPECT_RATIOS = sorted(itertools.chain.from_iterable([
-    ((math.atan(h / w), (w, h)), (math.atan(w / h), (h, w)))
-    for w, h in [
-        (1024, 1024),
-        (1024, 960),
-        (1088, 896),
-        (1088, 960),
-        (1152, 832),
-        (1152, 896),
-        (1216, 832),
-        (1280, 768),
-        (1344, 704),
-        (1344, 768),
-        (1408, 704),
-        (1472, 704),
-        (1536, 640),
-        (1600, 640),
-        (1664, 576),
-        (704, 1344),
-        (704, 1408),
-        (768, 1280),
-        (768, 1344),
-        (832, 1152),
-        (832, 1216),
-        (896, 1088),
-        (896, 1152),
-        (960, 1024),
-        (960, 1088),
-    ]
-]))
+OverlayKey = tuple[tuple[int, int], int, int, Optional[str], Optional[str]]
 
-def get_closest_dimensions(width: int, height: int) -> tuple[int, int]:
-    aspect = math.atan(height / width)
-    diffs = [
-        (abs(aspect - other), dim)
-        for other, dim in ASPECT_RATIOS
-    ]
 
-    _, closest = min(diffs, key=lambda i: i[0])
+class OverlayCache(lru.ByteLRU[OverlayKey, tuple[tuple[int, int], Optional[Image.Image]]]):
+    """Rendered overlays as RGBA layers, in an LRU bounded by bytes.
+
+    A layer only covers the pixels the text touches. Its colour and alpha are
+    recovered from drawing the overlay over black and over white, so pasting it
+    gives the same result as drawing the text directly, give or take rounding.
+    That costs a few times more than drawing once, and most prompts are only
+    ever seen once, so a layer is only rendered the second time its overlay
+    is asked for. Render threads share the cache, hence the lock.
+    """
+
+    def __init__(self, max_bytes: int, max_seen: int = 1024) -> None:
+        super().__init__(max_bytes, size=lambda cached: layer_bytes(cached[1]))
+        self.max_seen = max_seen
+        self._seen: collections.OrderedDict[OverlayKey, None] = collections.OrderedDict()
+        self._seen_lock = threading.Lock()
+
+    def layer(self, key: OverlayKey) -> Optional[tuple[tuple[int, int], Optional[Image.Image]]]:
+        """Where to paste the overlay and its layer, or None when it should be drawn directly this time."""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        with self._seen_lock:
+            if self._seen.pop(key, False) is False:
+                self._seen[key] = None
+                if len(self._seen) > self.max_seen:
+                    self._seen.popitem(last=False)
+                return None
+
+        cached = render_overlay(*key)
+        self.put(key, cached)
+        return cached
+
+
+def layer_bytes(layer: Optional[Image.Image]) -> int:
+    return layer.width * layer.height * 4 if layer is not None else 0
+
 
-    return closest
+def render_overlay(
+        size: tuple[int, int],
+        image_height: int,
+        image_width: int,
+        title_text: Optional[str],
+        artist_text: Optional[str],
+) -> tuple[tuple[int, int], Optional[Image.Image]]:
+    """The overlay for an RGB image of this size as a cropped RGBA layer and where it goes."""
+    over_black = Image.new('RGB', size, (0, 0, 0))
+    over_white = Image.new('RGB', size, (255, 255, 255))
+    add_text_to_image(over_black, image_height, image_width, title_text, artist_text)
+    add_text_to_image(over_white, image_height, image_width, title_text, artist_text)
+
+    # Drawing is out = image * (1 - alpha) + premultiplied colour, so black gives the colour and white the alpha
+    covered = ImageChops.invert(ImageChops.difference(over_white, over_black)).getbbox()
+    if covered is None:
+        return (0, 0), None
+
+    premultiplied = np.asarray(over_black.crop(covered), dtype=np.float32)
+    alpha = 255 - (np.asarray(over_white.crop(covered), dtype=np.float32) - premultiplied).max(axis=2)
+    colour = premultiplied * 255 / np.maximum(alpha, 1)[..., None]
+    layer = np.dstack([colour, alpha]).round().clip(0, 255).astype(np.uint8)
+    return covered[0:2], Image.fromarray(layer, mode='RGBA')
+
+
+def draw_overlay(
+        image: Image.Image,
+        image_height: int,
+        image_width: int,
+        title_text: Optional[str] = "",
+        artist_text: Optional[str] = "") -> None:
+    """add_text_to_image with the default layout, pasted from a cached layer when it can be.
+
+    Palette and transparent images are still drawn on directly, since their
+    result depends on the palette and the pixels under the text.
+    """
+    if image.mode != 'RGB':
+        add_text_to_image(image, image_height, image_width, title_text, artist_text)
+        return
+
+    cached = get_overlay_cache().layer((image.size, image_height, image_width, title_text, artist_text))
+    if cached is None:
+        add_text_to_image(image, image_height, image_width, title_text, artist_text)
+        return
+
+    position, layer = cached
+    if layer is not None:
+        image.paste(layer, position, mask=layer)
+
+
+_overlay_cache: Optional[OverlayCache] = None
+
+
+def get_overlay_cache() -> OverlayCache:
+    global _overlay_cache
+    if _overlay_cache is None:
+        _overlay_cache = OverlayCache(config.overlay_cache_bytes)
+    return _overlay_cache
+
+
+# The sizes SDXL was trained at, used unless the config lists its own
+SDXL_RESOLUTIONS = [
+    (1024, 1024),
+    (1024, 960),
+    (1088, 896),
+    (1088, 960),
+    (1152, 832),
+    (1152, 896),
+    (1216, 832),
+    (1280, 768),
+    (1344, 704),
+    (1344, 768),
+    (1408, 704),
+    (1472, 704),
+    (1536, 640),
+    (1600, 640),
+    (1664, 576),
+    (704, 1344),
+    (704, 1408),
+    (768, 1280),
+    (768, 1344),
+    (832, 1152),
+    (832, 1216),
+    (896, 1088),
+    (896, 1152),
+    (960, 1024),
+    (960, 1088),
+]
+
+
+class AspectTable:
+    """Generation sizes in both orientations, sorted by aspect angle for nearest aspect lookups."""
+
+    def __init__(self, resolutions: list[tuple[int, int]]) -> None:
+        self.entries = sorted(itertools.chain.from_iterable([
+            ((math.atan(h / w), (w, h)), (math.atan(w / h), (h, w)))
+            for w, h in resolutions
+        ]))
+        self.angles = [angle for angle, _ in self.entries]
+        # Index of the first entry with the same angle, which a min() over the whole table would pick
+        self.first = [bisect.bisect_left(self.angles, angle) for angle in self.angles]
+
+    def closest(self, width: int, height: int) -> tuple[int, int]:
+        aspect = math.atan(height / width)
+        index = bisect.bisect_left(self.angles, aspect)
+        candidates = [self.first[i] for i in (index - 1, index) if 0 <= i < len(self.angles)]
+        best = min(candidates, key=lambda i: abs(aspect - self.angles[i]))
+        # Rounding can leave an entry further left just as close, and the earliest one wins a tie
+        while best > 0 and abs(aspect - self.angles[best - 1]) == abs(aspect - self.angles[best]):
+            best = self.first[best - 1]
+        return self.entries[best][1]
+
+
+ASPECT_TABLE = AspectTable(config.resolutions or SDXL_RESOLUTIONS)
+ASPECT_RATIOS = ASPECT_TABLE.entries
+
+
+def get_closest_dimensions(width: int, height: int) -> tuple[int, int]:
+    return ASPECT_TABLE.closest(width, height)
+
+
+QUANTIZERS = ('pil', 'nearest', 'ordered')
+# Bits per channel of the nearest colour lookup table, 64^3 entries
+LOOKUP_BITS = 6
+
+# 8x8 Bayer matrix as thresholds centred on zero, in [-0.5, 0.5)
+BAYER = np.array([[0]])
+for _ in range(3):
+    BAYER = np.block([[4 * BAYER, 4 * BAYER + 2], [4 * BAYER + 3, 4 * BAYER + 1]])
+BAYER = (BAYER + 0.5) / BAYER.size - 0.5
+
+
+@functools.lru_cache(maxsize=32)
+def palette_colors(palette: str) -> bytes:
+    colors = base64.urlsafe_b64decode(palette)
+    return colors[:len(colors) - len(colors) % 3]
+
+
+@functools.lru_cache(maxsize=32)
+def palette_image(palette: str) -> Image.Image:
+    prepared = Image.new('P', (1, 1))
+    prepared.putpalette(list(base64.urlsafe_b64decode(palette)))
+    return prepared
+
+
+@functools.lru_cache(maxsize=32)
+def palette_lookup(palette: str) -> np.ndarray:
+    """Index of the nearest palette colour for every colour, at LOOKUP_BITS per channel."""
+    colors = np.frombuffer(palette_colors(palette), dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+    shift = 8 - LOOKUP_BITS
+    levels = (np.arange(1 << LOOKUP_BITS, dtype=np.int32) << shift) + (1 << shift >> 1)
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    # |g - c|^2 without the |g|^2 term, which is the same for every colour
+    distances = (colors ** 2).sum(axis=1)[None, :] - 2 * grid @ colors.T
+    return distances.argmin(axis=1).astype(np.uint8)
+
+
+def quantize(image: Image.Image, palette: str, method: str = 'pil') -> Image.Image:
+    """Reduce image to the colours of a URL-safe base64 RGB palette, as a 'P' image.
+
+    'pil' is Image.quantize with its Floyd-Steinberg dithering. 'nearest' maps
+    every pixel to its closest palette colour through a cached lookup table, and
+    'ordered' does the same after adding a Bayer dither pattern.
+    """
+    if method == 'pil':
+        return image.convert('RGB').quantize(palette=palette_image(palette))
+    if method not in QUANTIZERS:
+        raise ValueError("Unknown quantizer {}".format(method))
+
+    colors = palette_colors(palette)
+    pixels = np.asarray(image.convert('RGB'))
+    if method == 'ordered':
+        spread = 256 / max(1.0, (len(colors) // 3) ** (1 / 3))
+        tiles = (pixels.shape[0] + 7) // 8, (pixels.shape[1] + 7) // 8
+        pattern = np.tile(np.rint(BAYER * spread).astype(np.int16), tiles)[:pixels.shape[0], :pixels.shape[1], None]
+        dithered = pixels.astype(np.int16)
+        dithered += pattern
+        pixels = np.clip(dithered, 0, 255, out=dithered).astype(np.uint8)
+
+    shift = 8 - LOOKUP_BITS
+    packed = (
+        (pixels[..., 0].astype(np.uint32) >> shift) << (2 * LOOKUP_BITS)
+        | (pixels[..., 1].astype(np.uint32) >> shift) << LOOKUP_BITS
+        | pixels[..., 2] >> shift
+    )
+    quantized = Image.fromarray(palette_lookup(palette)[packed], mode='P')
+    quantized.putpalette(colors)
+    return quantized
+
+
+RESAMPLING = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'hamming': Image.Resampling.HAMMING,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+
+
+def resize(
+        image: Image.Image,
+        size: tuple[int, int],
+        resample: Optional[str] = None,
+        reducing_gap: Optional[float] = None) -> Image.Image:
+    """image scaled to size with the named filter from RESAMPLING, or PIL's default for its mode.
+
+    A box filter by a whole factor is the same as averaging blocks of pixels,
+    which reduce() does in a fraction of the time. reducing_gap lets the other
+    filters do the same for most of the way down, trading a little accuracy for
+    speed on big downscales.
+    """
+    width, height = size
+    if (resample == 'box' and image.mode not in ('1', 'P')
+            and image.width % width == 0 and image.height % height == 0):
+        return image.reduce((image.width // width, image.height // height))
+
+    return image.resize(size, resample=RESAMPLING[resample] if resample else None, reducing_gap=reducing_gap)
+
+
+def prepare_input(raw_image: bytes, width: int, height: int) -> bytes:
+    """Base64 PNG of an img2img source image, ready to send to the backend at width x height.
+
+    The backend stretches its input to the generation size anyway, so a larger
+    source is shrunk first. Metadata is dropped and the PNG is compressed for
+    speed rather than size, since it only goes over the wire once.
+    """
+    with Image.open(io.BytesIO(raw_image)) as source:
+        shrink = source.width * source.height > width * height
+        if shrink:
+            # JPEGs can be decoded at a fraction of their size for next to nothing
+            source.draft('RGB', (width, height))
+        prepared = source
+        if prepared.mode not in ('RGB', 'RGBA'):
+            prepared = prepared.convert('RGBA' if prepared.has_transparency_data else 'RGB')
+        if shrink:
+            prepared = prepared.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        return png_b64(prepared, compress_level=1)
+
+
+class Base64Writer(io.RawIOBase):
+    """A write only stream that appends the base64 of everything written to it to output.
+
+    Up to two bytes are held back between writes so every write encodes whole
+    groups of three, and close() encodes whatever is left.
+    """
+
+    def __init__(self, output: bytearray) -> None:
+        self.output = output
+        self.pending = b''
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        length = len(data)
+        if self.pending:
+            data = self.pending + bytes(data)
+        usable = len(data) - len(data) % 3
+        self.output += binascii.b2a_base64(memoryview(data)[:usable], newline=False)
+        self.pending = bytes(data[usable:])
+        return length
+
+    def close(self) -> None:
+        if not self.closed and self.pending:
+            self.output += binascii.b2a_base64(self.pending, newline=False)
+            self.pending = b''
+        super().close()
+
+
+def png_b64(image: Image.Image, **params) -> bytearray:
+    """image as a base64 PNG, encoded chunk by chunk as it is written rather than all at once at the end."""
+    output = bytearray()
+    with Base64Writer(output) as writer:
+        image.save(writer, format="PNG", **params)
+    return output
 
 
 def b64_img(image: Image.Image) -> str:
@@ -169,15 +472,10 @@ def b64_img(image: Image.Image) -> str:
 
 
 def raw_b64_img(image: Image.Image) -> str:
-    with io.BytesIO() as output_bytes:
-        metadata = None
-        for key, value in image.info.items():
-            if isinstance(key, str) and isinstance(value, str):
-                if metadata is None:
-                    metadata = PngImagePlugin.PngInfo()
-                metadata.add_text(key, value)
-        image.save(output_bytes, format="PNG", pnginfo=metadata)
-
-        bytes_data = output_bytes.getvalue()
-
-    return str(base64.b64encode(bytes_data), "utf-8")
+    metadata = None
+    for key, value in image.info.items():
+        if isinstance(key, str) and isinstance(value, str):
+            if metadata is None:
+                metadata = PngImagePlugin.PngInfo()
+            metadata.add_text(key, value)
+    return png_b64(image, pnginfo=metadata).decode('ascii')
@@ -0,0 +1,48 @@
+import dataclasses
+import logging
+from typing import Awaitable, Callable, Optional
+
+import discord
+
+from stabby import conf, lru
+
+logger = logging.getLogger('discord.stabby.inputs')
+
+
+@dataclasses.dataclass(frozen=True)
+class InputImage:
+    """The source attachment of an img2img generation.
+
+    Discord reports an image attachment's size up front, so the generation size
+    can be picked without downloading it. The image itself is only read when a
+    prepared copy at that size is not cached already.
+    """
+    message_id: int
+    attachment_id: int
+    width: int
+    height: int
+    read: Callable[[], Awaitable[bytes]] = dataclasses.field(compare=False, repr=False)
+
+    @classmethod
+    def from_attachment(cls, attachment: discord.Attachment, message_id: int) -> Optional['InputImage']:
+        if not attachment.width or not attachment.height:
+            # Not an image, or one Discord could not read either
+            return None
+        return cls(message_id, attachment.id, attachment.width, attachment.height, attachment.read)
+
+
+class InputCache(lru.ByteLRU[tuple[int, int, int], bytes]):
+    """Prepared img2img inputs by attachment and generation size, in an LRU bounded by bytes.
+
+    Attachments cannot be edited, so an entry never goes stale.
+    """
+
+
+_cache: Optional[InputCache] = None
+
+
+def get_cache() -> InputCache:
+    global _cache
+    if _cache is None:
+        _cache = InputCache(conf.load_conf().input_cache_bytes)
+    return _cache
@@ -0,0 +1,244 @@
+import asyncio
+import collections
+import dataclasses
+import logging
+from typing import Any, Awaitable, Callable, Hashable, Optional, Union
+
+from discord import File
+
+import stabby
+from stabby import backends, conf, generation
+from stabby.backends import GenerationError
+
+logger = logging.getLogger('discord.stabby.jobs')
+
+Result = tuple[File, dict[str, Any]]
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclasses.dataclass(eq=False)
+class Job:
+    params: dict[str, Any]
+    future: asyncio.Future
+    queue: 'JobQueue'
+
+    @property
+    def position(self) -> int:
+        """Place in line behind other waiting jobs, starting at 1, or 0 once a worker has it."""
+        return self.queue.position(self)
+
+    def __await__(self):
+        return self.future.__await__()
+
+
+class JobQueue:
+    """Bounded FIFO of generation jobs, drained by a number of workers that can only grow.
+
+    Limits how many generations hit the backend at once. When max_depth jobs
+    are already waiting, submit() rejects straight away instead of letting
+    requests pile up and time out.
+
+    With a batch_runner, a worker taking a job also takes up to batch_max - 1
+    waiting jobs with the same batch_key and runs them all in one call. It can
+    wait batch_window seconds first, to let a burst of similar jobs arrive.
+    """
+
+    def __init__(
+            self,
+            workers: Union[int, Callable[[], int]],
+            max_depth: int,
+            runner: Callable[[dict[str, Any]], Awaitable[Result]],
+            batch_runner: Optional[Callable[[list[dict[str, Any]]], Awaitable[list[Result]]]] = None,
+            batch_key: Optional[Callable[[dict[str, Any]], Optional[Hashable]]] = None,
+            batch_max: int = 1,
+            batch_window: float = 0.0,
+    ) -> None:
+        self._workers = workers
+        self.max_depth = max_depth
+        self.runner = runner
+        self.batch_runner = batch_runner
+        self.batch_key = batch_key
+        self.batch_max = batch_max
+        self.batch_window = batch_window
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched = 0
+        self._pending: collections.deque[Job] = collections.deque()
+        self._available: Optional[asyncio.Semaphore] = None
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def workers(self) -> int:
+        """How many workers there should be, which a callable can grow as backends are added."""
+        return self._workers() if callable(self._workers) else self._workers
+
+    def submit(self, params: dict[str, Any]) -> Job:
+        if len(self._pending) >= self.max_depth:
+            self.rejected += 1
+            raise QueueFull("{} generations are already waiting".format(len(self._pending)))
+
+        self._start()
+        assert self._available is not None
+
+        job = Job(params=params, future=asyncio.get_running_loop().create_future(), queue=self)
+        self._pending.append(job)
+        self._available.release()
+        return job
+
+    def position(self, job: Job) -> int:
+        try:
+            index = self._pending.index(job)
+        except ValueError:
+            return 0
+        # Idle workers are about to pick up the jobs at the front of the line
+        return max(0, index + 1 - (self.workers - self.busy))
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            workers=self.workers,
+            busy=self.busy,
+            waiting=len(self._pending),
+            completed=self.completed,
+            failed=self.failed,
+            rejected=self.rejected,
+            batches=self.batches,
+            batched=self.batched,
+        )
+
+    def _start(self) -> None:
+        # Workers are started lazily, since the queue is created before the event loop is running
+        if self._available is None:
+            self._available = asyncio.Semaphore(0)
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            task = asyncio.create_task(self._work())
+            task.add_done_callback(self._worker_done)
+            self._tasks.append(task)
+
+    def _worker_done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        logger.error("Generation worker died, starting a replacement", exc_info=task.exception())
+        if self._pending:
+            self._start()
+
+    def _key(self, job: Job) -> Optional[Hashable]:
+        if self.batch_runner is None or self.batch_key is None or self.batch_max <= 1:
+            return None
+        try:
+            return self.batch_key(job.params)
+        except Exception as ex:
+            logger.warning("Not batching job: {}".format(ex))
+            return None
+
+    def _take_compatible(self, key: Hashable) -> list[Job]:
+        taken = []
+        for job in list(self._pending):
+            if len(taken) >= self.batch_max - 1:
+                break
+            if not job.future.done() and self._key(job) == key:
+                self._pending.remove(job)
+                taken.append(job)
+        return taken
+
+    async def _work(self) -> None:
+        assert self._available is not None
+        while True:
+            await self._available.acquire()
+            if not self._pending:
+                continue
+
+            job = self._pending.popleft()
+            if job.future.done():
+                continue
+
+            self.busy += 1
+            batch = [job]
+            try:
+                key = self._key(job)
+                if key is not None:
+                    if self.batch_window > 0:
+                        await asyncio.sleep(self.batch_window)
+                    batch += self._take_compatible(key)
+
+                # Each job runs in its own task, so whatever the runner raises is handed over
+                # with a finished traceback and can never take the worker down with it
+                if len(batch) > 1:
+                    self.batches += 1
+                    self.batched += len(batch)
+                    assert self.batch_runner is not None
+                    running = asyncio.ensure_future(self.batch_runner([queued.params for queued in batch]))
+                else:
+                    running = asyncio.ensure_future(self.runner(job.params))
+
+                try:
+                    await asyncio.wait([running])
+                except BaseException:
+                    running.cancel()
+                    raise
+            except BaseException:
+                for queued in batch:
+                    queued.future.cancel()
+                raise
+            finally:
+                self.busy -= 1
+
+            if running.cancelled():
+                self.failed += len(batch)
+                for queued in batch:
+                    queued.future.cancel()
+            elif running.exception() is not None:
+                self.failed += len(batch)
+                for queued in batch:
+                    if not queued.future.done():
+                        queued.future.set_exception(running.exception())
+            else:
+                results = running.result() if len(batch) > 1 else [running.result()]
+                self.completed += min(len(batch), len(results))
+                self.failed += max(0, len(batch) - len(results))
+                for queued, result in zip(batch, results):
+                    if not queued.future.done():
+                        queued.future.set_result(result)
+                # A short list of results must not leave the jobs past its end waiting forever
+                for queued in batch[len(results):]:
+                    if not queued.future.done():
+                        queued.future.set_exception(GenerationError("The batch returned {} results for {} jobs".format(len(results), len(batch))))
+
+
+async def run_generation(params: dict[str, Any]) -> Result:
+    return await generation.generate_ai_image(
+        http_client=await stabby.get_http_client(),
+        **params
+    )
+
+
+async def run_generation_batch(batch: list[dict[str, Any]]) -> list[Result]:
+    return await generation.generate_ai_image_batch(
+        http_client=await stabby.get_http_client(),
+        batch=batch,
+    )
+
+
+_queue: Optional[JobQueue] = None
+
+
+def get_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        config = conf.load_conf()
+        _queue = JobQueue(
+            lambda: max(1, config.generation_workers, len(backends.get_pool().backends)),
+            config.generation_queue_depth,
+            run_generation,
+            batch_runner=run_generation_batch,
+            batch_key=generation.batch_key,
+            batch_max=config.generation_batch_max,
+            batch_window=config.generation_batch_window,
+        )
+    return _queue
@@ -0,0 +1,63 @@
+import collections
+import threading
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class ByteLRU(Generic[K, V]):
+    """Values by key, dropping the least recently used once their sizes add up to more than max_bytes.
+
+    A value bigger than the whole budget is never kept. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes: int, size: Callable[[V], int] = len) -> None:  # type: ignore[assignment]
+        self.max_bytes = max_bytes
+        self.size = size
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: collections.OrderedDict[K, V] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        size = self.size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= self.size(previous)
+
+            self._entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.bytes -= self.size(dropped)
+                self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(
+                entries=len(self._entries),
+                bytes=self.bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
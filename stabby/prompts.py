@@ -0,0 +1,239 @@
+import asyncio
+import collections
+import dataclasses
+import logging
+from typing import AsyncIterator, Callable, Mapping, Optional
+
+from stabby import conf, grammar, text_utils
+
+logger = logging.getLogger('discord.stabby.prompts')
+
+MAKER_FIELDS = [
+    'quality',
+    'subject',
+    'action',
+    'environment',
+    'object',
+    'color',
+    'style',
+    'mood',
+    'lighting',
+    'perspective',
+    'texture',
+    'time_period',
+    'cultural_elements',
+    'emotion',
+    'medium',
+]
+
+
+def make_random_prompt(args: dict) -> str:
+    return make_random_prompts(args, 1)[0]
+
+
+def make_random_prompts(args: dict, count: int) -> list[str]:
+    params: dict[str, Optional[str]] = dict.fromkeys(MAKER_FIELDS)
+
+    for arg in params:
+        passed = args.get(arg)
+        if passed is not None:
+            params[arg] = passed
+
+    prompts = text_utils.template_grammar_fill_many(params, grammar.get_registry().get('maker'), count, True)
+
+    return [text_utils.join_template_prompt(prompt) for prompt in prompts]
+
+
+def grammar_source(name: str, start: str = 'ROOT') -> Callable[[int], list[str]]:
+    def source(count: int) -> list[str]:
+        return grammar.get_registry().get(name).generate_many(count, start=start)
+    return source
+
+
+async def stream_prompts(
+        name: str,
+        count: int,
+        start: Optional[str] = None,
+        args: Optional[Mapping[str, str]] = None,
+        chunk_size: int = 64,
+) -> AsyncIterator[list[str]]:
+    """Generate count prompts from the named grammar in chunks, yielding to the event loop between chunks.
+
+    Maker prompts without a start symbol are full templates, filled around any field overrides in args.
+    """
+    while count > 0:
+        chunk = min(count, chunk_size)
+        if name == 'maker' and start is None:
+            yield make_random_prompts(args or {}, chunk)
+        else:
+            yield grammar.get_registry().get(name).generate_many(chunk, start=start or 'ROOT')
+        count -= chunk
+        await asyncio.sleep(0)
+
+
+@dataclasses.dataclass
+class PoolStats:
+    hits: int = 0
+    misses: int = 0
+    generated: int = 0
+
+
+class PromptPool:
+    """Bounded pools of pre-generated prompts, one per source, refilled in the background.
+
+    Taking a prompt never waits on the refill: an empty pool is a miss and the
+    prompt is generated on the spot. Once a pool drops below the low-water mark,
+    run() tops it back up to size in small chunks, yielding to the event loop
+    between chunks so it only uses time nothing else wants.
+    """
+
+    def __init__(self, size: int, low_water: int, chunk_size: int = 16) -> None:
+        self.size = size
+        self.low_water = low_water
+        self.chunk_size = chunk_size
+        self._sources: dict[str, Callable[[int], list[str]]] = {}
+        self._pools: dict[str, collections.deque[str]] = {}
+        self._stats: dict[str, PoolStats] = {}
+        self._wanted = asyncio.Event()
+
+    def register(self, key: str, source: Callable[[int], list[str]]) -> None:
+        self._sources[key] = source
+        self._pools[key] = collections.deque(maxlen=max(self.size, 1))
+        self._stats[key] = PoolStats()
+        self._wanted.set()
+
+    def pop(self, key: str, recent: Optional[grammar.RecentFilter] = None, retries: int = grammar.RECENT_RETRIES) -> str:
+        for _ in range(retries + 1):
+            prompt = self._take(key)
+            if recent is None or recent.admit(prompt):
+                break
+        return prompt
+
+    def _take(self, key: str) -> str:
+        pool = self._pools[key]
+        stats = self._stats[key]
+        if pool:
+            stats.hits += 1
+            prompt = pool.popleft()
+        else:
+            stats.misses += 1
+            prompt = self._sources[key](1)[0]
+
+        if len(pool) < self.low_water:
+            self._wanted.set()
+
+        return prompt
+
+    def clear(self) -> None:
+        for pool in self._pools.values():
+            pool.clear()
+        self._wanted.set()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            key: dict(dataclasses.asdict(stats), available=len(self._pools[key]))
+            for key, stats in self._stats.items()
+        }
+
+    def _most_depleted(self) -> Optional[str]:
+        if self.size <= 0:
+            return None
+
+        key = min(self._pools, key=lambda key: len(self._pools[key]), default=None)
+        if key is None or len(self._pools[key]) >= self.size:
+            return None
+        return key
+
+    async def fill(self) -> None:
+        while (key := self._most_depleted()) is not None:
+            pool = self._pools[key]
+            try:
+                prompts = self._sources[key](min(self.chunk_size, self.size - len(pool)))
+            except Exception as ex:
+                logger.exception(ex)
+                return
+            pool.extend(prompts)
+            self._stats[key].generated += len(prompts)
+            await asyncio.sleep(0)
+
+    async def run(self) -> None:
+        while True:
+            await self._wanted.wait()
+            self._wanted.clear()
+            await self.fill()
+
+
+class RecentFilters:
+    """One RecentFilter per guild, so each server gets its own no-repeat window.
+
+    At most max_guilds filters are kept. The least recently used one is dropped to
+    make room, so DMs, which are keyed by user, cannot grow memory without limit.
+    """
+
+    def __init__(self, size: int, retries: int, max_guilds: int = 1000) -> None:
+        self.size = size
+        self.retries = retries
+        self.max_guilds = max_guilds
+        self.evicted = 0
+        self._filters: collections.OrderedDict[int, grammar.RecentFilter] = collections.OrderedDict()
+        # Counters of dropped filters, so the hit rate covers everything ever checked
+        self._retired_checks = 0
+        self._retired_hits = 0
+
+    def get(self, guild_id: Optional[int]) -> Optional[grammar.RecentFilter]:
+        if self.size <= 0 or self.max_guilds <= 0 or guild_id is None:
+            return None
+
+        recent = self._filters.get(guild_id)
+        if recent is not None:
+            self._filters.move_to_end(guild_id)
+            return recent
+
+        while len(self._filters) >= self.max_guilds:
+            _, dropped = self._filters.popitem(last=False)
+            self._retired_checks += dropped.checks
+            self._retired_hits += dropped.hits
+            self.evicted += 1
+
+        recent = self._filters[guild_id] = grammar.RecentFilter(self.size)
+        return recent
+
+    def stats(self) -> dict[str, float]:
+        checks = self._retired_checks + sum(recent.checks for recent in self._filters.values())
+        hits = self._retired_hits + sum(recent.hits for recent in self._filters.values())
+        return dict(
+            guilds=len(self._filters),
+            evicted=self.evicted,
+            checks=checks,
+            hits=hits,
+            hit_rate=hits / checks if checks else 0.0,
+        )
+
+
+_pool: Optional[PromptPool] = None
+_recent_filters: Optional[RecentFilters] = None
+
+
+def get_pool() -> PromptPool:
+    global _pool
+    if _pool is None:
+        config = conf.load_conf()
+        _pool = PromptPool(config.prompt_pool_size, config.prompt_pool_low_water)
+        _pool.register('prompt:ROOT', grammar_source('prompt'))
+        _pool.register('karma:ROOT', grammar_source('karma'))
+        _pool.register('maker:random', lambda count: make_random_prompts({}, count))
+    return _pool
+
+
+def get_recent_filters() -> RecentFilters:
+    global _recent_filters
+    if _recent_filters is None:
+        config = conf.load_conf()
+        _recent_filters = RecentFilters(config.recent_filter_size, config.recent_filter_retries, config.recent_filter_guilds)
+    return _recent_filters
+
+
+def pop_fresh(key: str, guild_id: Optional[int]) -> str:
+    """Take a pooled prompt, resampling a bounded number of times to avoid ones the guild saw recently."""
+    filters = get_recent_filters()
+    return get_pool().pop(key, recent=filters.get(guild_id), retries=filters.retries)
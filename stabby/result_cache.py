@@ -0,0 +1,186 @@
+import asyncio
+import collections
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from typing import Any, Optional
+
+from stabby import conf, lru
+
+logger = logging.getLogger('discord.stabby.result_cache')
+
+
+@dataclasses.dataclass(frozen=True)
+class CachedResult:
+    data: bytes
+    filename: str
+    reprompt: dict[str, Any]
+
+
+def result_key(payload: dict[str, Any], options: dict[str, Any]) -> str:
+    """Canonical hash of everything that decides the output of a fixed seed generation."""
+    canonical = json.dumps(dict(payload=payload, options=options), sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """Finished generations by result_key, in a memory LRU backed by an optional directory.
+
+    Both tiers are bounded in bytes and drop their least recently used entries
+    first. Memory hits are served without touching the disk, and disk hits are
+    promoted back into memory.
+
+    From the event loop, use fetch() and store(), which leave the pickling and
+    file access of the disk tier to a thread.
+    """
+
+    def __init__(self, max_bytes: int, cache_dir: Optional[str] = None, max_disk_bytes: int = 0) -> None:
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        self._memory: lru.ByteLRU[str, CachedResult] = lru.ByteLRU(max_bytes, size=lambda result: len(result.data))
+        self._disk: Optional[collections.OrderedDict[str, int]] = None
+        # Held for a file read or write, while the memory tier stays available
+        self._disk_lock = threading.Lock()
+
+    @property
+    def hits(self) -> int:
+        return self._memory.hits
+
+    @property
+    def misses(self) -> int:
+        # Every miss starts as a memory miss, some of which the disk answers
+        return self._memory.misses - self.disk_hits
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        result = self._memory.get(key)
+        if result is not None or not self.cache_dir:
+            return result
+        return self._get_from_disk(key)
+
+    def put(self, key: str, result: CachedResult) -> None:
+        self._memory.put(key, result)
+        self._store_on_disk(key, result)
+
+    async def fetch(self, key: str) -> Optional[CachedResult]:
+        result = self._memory.get(key)
+        if result is not None or not self.cache_dir:
+            return result
+        return await asyncio.get_running_loop().run_in_executor(None, self._get_from_disk, key)
+
+    async def store(self, key: str, result: CachedResult) -> None:
+        self._memory.put(key, result)
+        if self.cache_dir and self.max_disk_bytes > 0:
+            await asyncio.get_running_loop().run_in_executor(None, self._store_on_disk, key, result)
+
+    def stats(self) -> dict[str, int]:
+        with self._disk_lock:
+            disk_entries = len(self._disk_index())
+            disk_bytes = sum(self._disk_index().values())
+            disk_hits = self.disk_hits
+            disk_evictions = self.disk_evictions
+        memory = self._memory.stats()
+        return dict(
+            memory,
+            disk_hits=disk_hits,
+            misses=memory['misses'] - disk_hits,
+            disk_entries=disk_entries,
+            disk_bytes=disk_bytes,
+            disk_evictions=disk_evictions,
+        )
+
+    def _get_from_disk(self, key: str) -> Optional[CachedResult]:
+        with self._disk_lock:
+            result = self._load(key)
+            if result is None:
+                return None
+            self.disk_hits += 1
+        self._memory.put(key, result)
+        return result
+
+    def _store_on_disk(self, key: str, result: CachedResult) -> None:
+        with self._disk_lock:
+            self._store(key, result)
+
+    def _path(self, key: str) -> str:
+        assert self.cache_dir is not None
+        return os.path.join(self.cache_dir, key + '.result')
+
+    def _disk_index(self) -> collections.OrderedDict[str, int]:
+        if self._disk is None:
+            self._disk = collections.OrderedDict()
+            if self.cache_dir and os.path.isdir(self.cache_dir):
+                # Oldest first, so eviction order survives a restart
+                entries = []
+                for entry in os.scandir(self.cache_dir):
+                    if entry.name.endswith('.result'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, entry.name[:-len('.result')], stat.st_size))
+                for _, key, size in sorted(entries):
+                    self._disk[key] = size
+        return self._disk
+
+    def _load(self, key: str) -> Optional[CachedResult]:
+        if not self.cache_dir or key not in self._disk_index():
+            return None
+
+        try:
+            with open(self._path(key), 'rb') as file:
+                result = pickle.load(file)
+        except Exception as ex:
+            logger.warning("Dropping unreadable cached result {}: {}".format(key, ex))
+            self._forget(key)
+            return None
+
+        self._disk_index().move_to_end(key)
+        # Keep the file's age in step with its place in the index
+        os.utime(self._path(key))
+        return result
+
+    def _store(self, key: str, result: CachedResult) -> None:
+        if not self.cache_dir or self.max_disk_bytes <= 0:
+            return
+
+        index = self._disk_index()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as file:
+                pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(key))
+            index[key] = os.path.getsize(self._path(key))
+            index.move_to_end(key)
+        except OSError as ex:
+            logger.warning("Could not write cached result {}: {}".format(key, ex))
+            return
+
+        total = sum(index.values())
+        while total > self.max_disk_bytes and index:
+            dropped = next(iter(index))
+            total -= index[dropped]
+            self._forget(dropped)
+            self.disk_evictions += 1
+
+    def _forget(self, key: str) -> None:
+        self._disk_index().pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+_cache: Optional[ResultCache] = None
+
+
+def get_cache() -> ResultCache:
+    global _cache
+    if _cache is None:
+        config = conf.load_conf()
+        _cache = ResultCache(config.result_cache_bytes, config.result_cache_dir, config.result_cache_disk_bytes)
+    return _cache
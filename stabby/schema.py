@@ -7,8 +7,8 @@ from datetime import datetime
 from typing import Optional, TypeVar
 from sqlalchemy import BigInteger, UniqueConstraint, func
 from sqlalchemy import DateTime
-from sqlalchemy import create_engine
-from sqlalchemy import select
+from sqlalchemy import Engine, create_engine
+from sqlalchemy import inspect, select, text
 from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
@@ -71,6 +71,30 @@ class StabbyTable(DeclarativeBase, MappedAsDataclass, repr=False):
 
 def init_db():
     StabbyTable.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+
+
+def add_missing_columns(bind: Engine):
+    """Add nullable columns that tables created by an older version are missing.
+
+    create_all only creates tables that do not exist yet, so a column added to
+    an existing table would otherwise never show up.
+    """
+    with bind.begin() as connection:
+        inspector = inspect(connection)
+        for table in StabbyTable.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    logger.warning("Column {}.{} is missing and has to be added by hand".format(table.name, column.name))
+                    continue
+                logger.info("Adding column {}.{}".format(table.name, column.name))
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, column.name, column_type)))
 
 
 class Preferences(StabbyTable):
@@ -227,3 +251,4 @@ class GenerationServer(StabbyTable):
 
     token: Mapped[str] = mapped_column(nullable=False, default=None, repr=False)
     status: Mapped[ServerStatus] = mapped_column(nullable=False, default=None)
+    url: NullMapped[str] = mapped_column(nullable=True, default=None)
@@ -93,6 +93,35 @@ def template_grammar_fill(input: Mapping[str, Optional[str]], grammar: stabby.gr
             output[field] = grammar.generate(start=field.capitalize())
     return output
 
+
+def template_grammar_fill_many(input: Mapping[str, Optional[str]], grammar: stabby.grammar.Grammar, count: int, fill: bool = True) -> list[dict[str, str]]:
+    columns: dict[str, list[str]] = dict()
+    for field, value in input.items():
+        if value is not None:
+            columns[field] = [value] * count
+        elif fill:
+            columns[field] = grammar.generate_many(count, start=field.capitalize())
+    return [
+        {field: values[idx] for field, values in columns.items()}
+        for idx in range(count)
+    ]
+
+
+def join_template_prompt(prompt: dict[str, str]) -> str:
+    prompt = dict(prompt)
+    prompt_text = ''
+    for joint_fields in [
+        ['subject', 'object', 'action'],
+        ['perspective', 'quality', 'medium', 'style'],
+    ]:
+        prompt_text += ' '.join([prompt.pop(field, '') for field in joint_fields])
+        prompt_text += ', '
+
+    prompt_text += ', '.join([v for v in prompt.values() if v])
+    prompt_text = re.sub(r'[ ]+', ' ', prompt_text)
+
+    return prompt_text
+
 def convert_to_bool(input: Union[bool, str, int, float]) -> bool:
     match type(input):
         case builtins.bool:
@@ -1,10 +1,18 @@
-from typing import Any, Callable, Sequence, Tuple, List, Dict, Text, overload
+from typing import Any, Callable, Sequence, Tuple, List, Dict, Text, Optional, overload
 from functools import wraps
 from inspect import signature
+import asyncio
+import base64
+import io
+import json
 import unittest
 
 import collections.abc
 
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image
+
 
 CaseTupleSequence = Sequence[Tuple[Any, ...]]
 CaseDictSequence = Sequence[Dict[Text, Any]]
@@ -70,3 +78,109 @@ def with_params(description, cases) -> Callable:
                     f(self, *args, **{**case, **kwargs})
         return wrapper
     return decorator
+
+
+def png_b64(width: int, height: int, color=(200, 30, 30)) -> str:
+    with io.BytesIO() as output:
+        Image.new('RGB', (width, height), color).save(output, format='PNG')
+        return base64.b64encode(output.getvalue()).decode()
+
+
+class FakeSDServer:
+    """A stand-in for the Stable Diffusion web API, answering with solid colour images."""
+
+    def __init__(self, delay: float = 0.0, status: int = 200, grid: bool = False, serial: bool = False, task_progress: bool = True) -> None:
+        self.delay = delay
+        self.status = status
+        self.grid = grid
+        self.requests: list[dict] = []
+        self.progress = 0.0
+        self.progress_polls = 0
+        # Run one generation at a time and queue the rest, like the real thing
+        self._serial = asyncio.Lock() if serial else None
+        self.current_task: Optional[str] = None
+        self.pings = 0
+        # Report only this many of a batch's seeds, like a misbehaving backend
+        self.seed_limit: Optional[int] = None
+        app = web.Application()
+        app.router.add_route('HEAD', '/', self.ping)
+        app.router.add_get('/sdapi/v1/progress', self.report_progress)
+        if task_progress:
+            app.router.add_post('/internal/progress', self.report_task_progress)
+        app.router.add_post('/sdapi/v1/txt2img', self.generate)
+        app.router.add_post('/sdapi/v1/img2img', self.generate)
+        self.server = TestServer(app)
+
+    @property
+    def url(self) -> str:
+        return str(self.server.make_url('')).rstrip('/')
+
+    async def __aenter__(self) -> 'FakeSDServer':
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.server.close()
+
+    async def ping(self, request: web.Request) -> web.Response:
+        self.pings += 1
+        return web.Response(status=self.status)
+
+    async def report_progress(self, request: web.Request) -> web.Response:
+        self.progress_polls += 1
+        current_image = None
+        if request.query.get('skip_current_image') == 'false' and 0 < self.progress < 1:
+            current_image = png_b64(8, 8)
+        return web.json_response(dict(
+            progress=self.progress,
+            eta_relative=self.delay * (1 - self.progress),
+            current_image=current_image,
+        ))
+
+    async def report_task_progress(self, request: web.Request) -> web.Response:
+        self.progress_polls += 1
+        query = await request.json()
+        if query['id_task'] != self.current_task:
+            return web.json_response(dict(active=False, progress=None, eta=None, live_preview=None, id_live_preview=-1))
+        step = int(self.progress * 10)
+        live_preview = None
+        if query.get('live_preview') and step > 0 and query['id_live_preview'] != step:
+            live_preview = 'data:image/png;base64,' + png_b64(8, 8)
+        return web.json_response(dict(
+            active=True,
+            progress=self.progress,
+            eta=self.delay * (1 - self.progress),
+            live_preview=live_preview,
+            id_live_preview=step,
+        ))
+
+    async def generate(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.requests.append(payload)
+        if self._serial is not None:
+            await self._serial.acquire()
+        try:
+            self.current_task = payload.get('force_task_id')
+            for step in range(10):
+                self.progress = step / 10
+                await asyncio.sleep(self.delay / 10)
+            self.progress = 0.0
+            self.current_task = None
+        finally:
+            if self._serial is not None:
+                self._serial.release()
+        if self.status != 200:
+            return web.json_response(dict(error='broken'), status=self.status)
+
+        count = payload.get('batch_size', 1)
+        seed = payload.get('seed', -1)
+        seeds = [seed + idx if seed != -1 else 1000 + len(self.requests) * 10 + idx for idx in range(count)]
+        info = {key: payload.get(key) for key in ('prompt', 'negative_prompt', 'steps', 'cfg_scale', 'width', 'height')}
+        info.update(seed=seeds[0], all_seeds=seeds[:self.seed_limit])
+        images = [png_b64(payload['width'], payload['height'], (seed % 256, 30, 30)) for seed in seeds]
+        if self.grid and count > 1:
+            images.insert(0, png_b64(payload['width'] * count, payload['height']))
+        return web.json_response(dict(
+            images=images,
+            info=json.dumps(info),
+        ))
@@ -0,0 +1,187 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+
+from stabby import backends, conf, generation, schema
+from tests.helpers import FakeSDServer
+
+
+class TestBackendPool(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.http_client = aiohttp.ClientSession()
+        self.addAsyncCleanup(self.http_client.close)
+
+    async def serve(self, server: FakeSDServer) -> FakeSDServer:
+        await server.__aenter__()
+        self.addAsyncCleanup(server.__aexit__)
+        return server
+
+    def test_least_loaded(self):
+        first, second, third = [backends.Backend(url, breaker=backends.CircuitBreaker(1, 30)) for url in 'abc']
+        pool = backends.BackendPool([first, second, third])
+        first.in_flight = 1
+        second.latency, third.latency = 2.0, 1.0
+        self.assertIs(pool.select(), third)
+
+        third.breaker.failure()
+        self.assertIs(pool.select(), second)
+
+        first.breaker.failure()
+        second.breaker.failure()
+        with self.assertRaises(backends.NoBackendAvailable):
+            pool.select()
+
+    def test_circuit_breaker(self):
+        now = [0.0]
+        breaker = backends.CircuitBreaker(failure_threshold=2, cooldown=10, clock=lambda: now[0])
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allows())
+
+        now[0] = 10
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertTrue(breaker.allows())
+        breaker.begin()
+        # Only one trial at a time while half-open
+        self.assertFalse(breaker.allows())
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        now[0] = 20
+        breaker.begin()
+        breaker.success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_configured_backends(self):
+        schema.init_db()
+        with schema.db_session() as session:
+            session.add(schema.GenerationServer(owner_id=1, token='secret', status=schema.ServerStatus.Online, url='http://gpu-box:7860'))
+            session.add(schema.GenerationServer(owner_id=1, token='secret', status=schema.ServerStatus.Offline, url='http://dead-box:7860'))
+            session.commit()
+        self.addCleanup(self.clear_servers)
+
+        config = conf.load_conf().model_copy(update=dict(sd_hosts=['http://a:7860', 'http://b:7860']))
+        configured = backends.configured_backends(config)
+        self.assertEqual([backend.url for backend in configured], ['http://a:7860', 'http://b:7860', 'http://gpu-box:7860'])
+        self.assertEqual(configured[2].headers, {'Authorization': 'Bearer secret'})
+
+        config = conf.load_conf().model_copy(update=dict(sd_hosts=[], sd_host='http://only:7860'))
+        self.assertEqual(backends.configured_backends(config)[0].url, 'http://only:7860')
+
+    def clear_servers(self):
+        with schema.db_session() as session:
+            session.query(schema.GenerationServer).delete()
+            session.commit()
+
+    async def test_spreads_jobs(self):
+        servers = [await self.serve(FakeSDServer(delay=0.05)) for _ in range(2)]
+        pool = backends.BackendPool([backends.Backend(server.url) for server in servers])
+
+        results = await asyncio.gather(*[
+            generation.generate_ai_image(self.http_client, prompt='a frog {}'.format(n), width=64, height=64, overlay=False, pool=pool)
+            for n in range(4)
+        ])
+        self.assertEqual(len(results), 4)
+        self.assertEqual([len(server.requests) for server in servers], [2, 2])
+        for backend in pool.backends:
+            self.assertEqual((backend.in_flight, backend.completed), (0, 2))
+            self.assertIsNotNone(backend.latency)
+
+    async def test_refresh(self):
+        kept, dropped = backends.Backend('http://kept'), backends.Backend('http://dropped')
+        kept.completed = 3
+        loaded = [[backends.Backend('http://kept'), backends.Backend('http://added')]]
+
+        def loader() -> list[backends.Backend]:
+            if not loaded:
+                raise RuntimeError('database is down')
+            return loaded.pop()
+
+        pool = backends.BackendPool([kept, dropped], loader=loader)
+        with mock.patch.object(conf.load_conf(), 'backend_refresh_interval', 0), \
+                mock.patch.object(backends.Backend, 'ping', mock.AsyncMock(return_value=True)):
+            await pool.check(self.http_client)
+            self.assertEqual([backend.url for backend in pool.backends], ['http://kept', 'http://added'])
+            self.assertIs(pool.backends[0], kept)
+
+            # A failed reload keeps the backends it already has
+            with self.assertLogs(backends.logger, 'WARNING'):
+                await pool.check(self.http_client)
+            self.assertEqual(len(pool.backends), 2)
+
+    async def test_health_check(self):
+        online = await self.serve(FakeSDServer())
+        broken = await self.serve(FakeSDServer(status=500))
+        pool = backends.BackendPool([backends.Backend(server.url, breaker=backends.CircuitBreaker(1, 30)) for server in (broken, online)])
+
+        self.assertTrue(await pool.check(self.http_client))
+        self.assertEqual([backend.observed_online for backend in pool.backends], [False, True])
+
+        await generation.generate_ai_image(self.http_client, prompt='a frog', width=64, height=64, overlay=False, pool=pool)
+        self.assertEqual((len(broken.requests), len(online.requests)), (0, 1))
+
+        # Neither the open breaker nor the backend that just served a request get pinged
+        await pool.check(self.http_client)
+        self.assertEqual((broken.pings, online.pings), (1, 1))
+
+        pool.backends[0].breaker.opened_at -= 30
+        broken.status = 200
+        await pool.check(self.http_client)
+        self.assertEqual(pool.backends[0].breaker.state, backends.CircuitBreaker.CLOSED)
+
+    async def test_failed_request(self):
+        broken = await self.serve(FakeSDServer(status=500))
+        pool = backends.BackendPool([backends.Backend(broken.url)])
+
+        with self.assertLogs(generation.logger, 'ERROR'), self.assertRaises(generation.GenerationError):
+            await generation.generate_ai_image(self.http_client, prompt='a frog', width=64, height=64, overlay=False, pool=pool)
+        self.assertEqual((pool.backends[0].failed, pool.backends[0].in_flight), (1, 0))
+
+        # A rejected request is not the backend's fault
+        broken.status = 422
+        pool = backends.BackendPool([backends.Backend(broken.url, breaker=backends.CircuitBreaker(1, 30))])
+        with self.assertLogs(generation.logger, 'ERROR'), self.assertRaises(backends.RequestRejected):
+            await generation.generate_ai_image(self.http_client, prompt='a frog', seed=3, width=64, height=64, overlay=False, pool=pool)
+        self.assertEqual(len(broken.requests), 2)
+        self.assertEqual(pool.backends[0].breaker.state, backends.CircuitBreaker.CLOSED)
+
+    async def test_retry_fixed_seed(self):
+        broken = await self.serve(FakeSDServer(status=500))
+        online = await self.serve(FakeSDServer(delay=0.05))
+        pool = backends.BackendPool([backends.Backend(broken.url), backends.Backend(online.url)])
+        pool.backends[0].latency, pool.backends[1].latency = 0.0, 1.0
+
+        with mock.patch.object(generation.config, 'generation_retry_delay', 0.01), self.assertLogs(generation.logger, 'WARNING'):
+            _, reprompt = await generation.generate_ai_image(self.http_client, prompt='a frog', seed=3, width=64, height=64, overlay=False, pool=pool)
+            self.assertEqual(reprompt['seed'], 3)
+
+            # Random seeds are not retried
+            with self.assertRaises(generation.GenerationError):
+                await generation.generate_ai_image(self.http_client, prompt='a frog', width=64, height=64, overlay=False, pool=pool)
+        self.assertEqual((len(broken.requests), len(online.requests)), (2, 1))
+
+    async def test_adaptive_timeout(self):
+        server = await self.serve(FakeSDServer(delay=0.05))
+        backend = backends.Backend(server.url, breaker=backends.CircuitBreaker(1, 30))
+        pool = backends.BackendPool([backend])
+        self.assertEqual(backend.timeout(1.0), conf.load_conf().generation_timeout)
+
+        await generation.generate_ai_image(self.http_client, prompt='a frog', steps=10, width=100, height=100, overlay=False, pool=pool)
+        self.assertGreaterEqual(backend.step_time, 0.05 / 0.1)
+        self.assertEqual(backend.timeout(0.1), max(conf.load_conf().generation_timeout_min, conf.load_conf().generation_timeout_factor * backend.step_time * 0.1))
+
+        server.delay = 1.0
+        with mock.patch.object(conf.load_conf(), 'generation_timeout_min', 0.1), self.assertRaises(backends.BackendTimeout):
+            await generation.generate_ai_image(self.http_client, prompt='a frog', steps=10, width=100, height=100, overlay=False, pool=pool)
+        self.assertEqual(backend.breaker.state, backends.CircuitBreaker.OPEN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+import asyncio
+import base64
+import concurrent.futures
+import functools
+import io
+import json
+import unittest
+from unittest import mock
+
+import aiohttp
+from PIL import Image
+
+from stabby import backends, generation, inputs, result_cache
+from tests.helpers import FakeSDServer, png_b64
+
+
+class TestGeneration(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.http_client = aiohttp.ClientSession()
+        self.addAsyncCleanup(self.http_client.close)
+
+    async def serve(self, server: FakeSDServer) -> backends.BackendPool:
+        await server.__aenter__()
+        self.addAsyncCleanup(server.__aexit__)
+        return backends.BackendPool([backends.Backend(server.url)])
+
+    def test_batch_key(self):
+        key = generation.batch_key(dict(prompt='a frog', width=64))
+        self.assertEqual(key, generation.batch_key(dict(prompt='a frog', width=64, overlay=False, palette='AAAA')))
+        self.assertNotEqual(key, generation.batch_key(dict(prompt='a frog', width=128)))
+        self.assertIsNone(generation.batch_key(dict(prompt='a frog', seed=5)))
+        input_image = inputs.InputImage(1, 2, 8, 8, read=None)
+        self.assertIsNone(generation.batch_key(dict(prompt='a frog', input_image=input_image)))
+
+    async def test_batch(self):
+        server = FakeSDServer(grid=True)
+        pool = await self.serve(server)
+        batch = [
+            dict(prompt='a frog', width=64, height=64, overlay=False),
+            dict(prompt='a frog', width=64, height=64, overlay=False, resize_dimensions=(16, 16)),
+            dict(prompt='a frog', width=64, height=64, overlay=False, format='JPEG'),
+        ]
+        results = await generation.generate_ai_image_batch(self.http_client, batch, pool=pool)
+
+        (request,) = server.requests
+        self.assertEqual(request['batch_size'], 3)
+        self.assertEqual([reprompt['seed'] for _, reprompt in results], [1010, 1011, 1012])
+        self.assertNotIn('batch_size', results[0][1])
+
+        sizes = [Image.open(file.fp).size for file, _ in results]
+        self.assertEqual(sizes, [(64, 64), (16, 16), (64, 64)])
+        # Each job gets its own image of the batch, not the grid in front
+        colours = [Image.open(file.fp).convert('RGB').getpixel((0, 0))[0] for file, _ in results]
+        self.assertEqual(colours[0], 1010 % 256)
+
+    async def test_batch_short_seeds(self):
+        server = FakeSDServer()
+        server.seed_limit = 1
+        pool = await self.serve(server)
+        batch = [dict(prompt='a frog', width=64, height=64, overlay=False) for _ in range(3)]
+        results = await generation.generate_ai_image_batch(self.http_client, batch, pool=pool)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][1]['seed'], 1010)
+
+    async def test_single(self):
+        server = FakeSDServer()
+        pool = await self.serve(server)
+        file, reprompt = await generation.generate_ai_image(self.http_client, prompt='a frog', seed=7, width=64, height=64, overlay=False, pool=pool)
+        self.assertNotIn('batch_size', server.requests[0])
+        self.assertEqual(reprompt['seed'], 7)
+        self.assertEqual(Image.open(file.fp).size, (64, 64))
+
+    async def test_result_cache(self):
+        server = FakeSDServer()
+        pool = await self.serve(server)
+        cache = result_cache.ResultCache(max_bytes=10 ** 6)
+        params = dict(prompt='a frog', seed=7, width=64, height=64, overlay=False, pool=pool)
+
+        with mock.patch.object(result_cache, '_cache', cache):
+            first, first_reprompt = await generation.generate_ai_image(self.http_client, **params)
+            second, second_reprompt = await generation.generate_ai_image(self.http_client, spoiler=True, **params)
+            await generation.generate_ai_image(self.http_client, **dict(params, format='JPEG'))
+            await generation.generate_ai_image(self.http_client, **dict(params, seed=-1))
+            await generation.generate_ai_image(self.http_client, **dict(params, seed=-1))
+
+        # Only the repeated fixed seed request skips the backend
+        self.assertEqual(len(server.requests), 4)
+        self.assertEqual(first.fp.getvalue(), second.fp.getvalue())
+        self.assertEqual(first_reprompt, second_reprompt)
+        self.assertTrue(second.spoiler)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    async def test_cached_result(self):
+        server = FakeSDServer()
+        pool = await self.serve(server)
+        cache = result_cache.ResultCache(max_bytes=10 ** 6)
+        params = dict(prompt='a frog', seed=7, width=64, height=64, overlay=False)
+
+        with mock.patch.object(result_cache, '_cache', cache):
+            self.assertIsNone(await generation.cached_result(params))
+            self.assertIsNone(await generation.cached_result(dict(params, seed=-1)))
+            file, reprompt = await generation.generate_ai_image(self.http_client, pool=pool, **params)
+            cached_file, cached_reprompt = await generation.cached_result(params)
+        self.assertEqual((cached_file.fp.getvalue(), cached_reprompt), (file.fp.getvalue(), reprompt))
+        self.assertEqual(len(server.requests), 1)
+
+    async def test_img2img_input(self):
+        server = FakeSDServer()
+        pool = await self.serve(server)
+        reads = []
+
+        async def read() -> bytes:
+            reads.append(True)
+            return base64.b64decode(png_b64(256, 256, (0, 200, 0)))
+
+        input_image = inputs.InputImage(message_id=11, attachment_id=8675309, width=256, height=256, read=read)
+        # Stream the body in small pieces, so the image is split across several
+        with mock.patch.object(generation, 'BODY_CHUNK', 7):
+            for seed in (1, 2):
+                _, reprompt = await generation.generate_ai_image(
+                    self.http_client, prompt='a frog', seed=seed, width=64, height=64, overlay=False, input_image=input_image, pool=pool)
+                self.assertEqual(reprompt['init_images'], 11)
+
+        # The second generation reused the prepared input instead of downloading it again
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(inputs.get_cache().stats()['hits'], 1)
+        (first, second) = server.requests
+        self.assertEqual(first['init_images'], second['init_images'])
+        prepared = Image.open(io.BytesIO(base64.b64decode(first['init_images'][0].split(',', 1)[1])))
+        self.assertEqual((prepared.size, prepared.getpixel((0, 0))), ((64, 64), (0, 200, 0)))
+
+    async def test_progress(self):
+        server = FakeSDServer(delay=0.3)
+        pool = await self.serve(server)
+        feed = generation.ProgressFeed(previews=True)
+        updates: list[generation.Progress] = []
+
+        async def watch():
+            async for update in feed:
+                updates.append(update)
+
+        watcher = asyncio.create_task(watch())
+        with mock.patch.object(generation.config, 'progress_interval', 0.02):
+            await generation.generate_ai_image(self.http_client, prompt='a frog', width=64, height=64, overlay=False, progress=feed, pool=pool)
+
+        # Iteration ends with the generation
+        await asyncio.wait_for(watcher, timeout=1)
+        self.assertGreater(len(updates), 3)
+        fractions = [update.fraction for update in updates]
+        self.assertEqual(fractions, sorted(fractions))
+        self.assertTrue(any(Image.open(io.BytesIO(update.preview)).size == (8, 8) for update in updates if update.preview))
+
+        polls = server.progress_polls
+        await asyncio.sleep(0.05)
+        self.assertEqual(server.progress_polls, polls)
+        # The task tag is only for the backend
+        self.assertTrue(server.requests[0]['force_task_id'].startswith('task('))
+
+    async def concurrent_progress(self, server: FakeSDServer) -> list[list[generation.Progress]]:
+        """Progress of two generations on one backend, the second queued behind the first."""
+        pool = await self.serve(server)
+        feeds = [generation.ProgressFeed(previews=True), generation.ProgressFeed(previews=True)]
+        updates: list[list[generation.Progress]] = [[], []]
+
+        async def watch(feed, seen):
+            async for update in feed:
+                seen.append(update)
+
+        watchers = [asyncio.create_task(watch(feed, seen)) for feed, seen in zip(feeds, updates)]
+        with mock.patch.object(generation.config, 'progress_interval', 0.01):
+            await asyncio.gather(*(
+                generation.generate_ai_image(self.http_client, prompt='a frog', width=64, height=64, overlay=False, progress=feed, pool=pool)
+                for feed in feeds
+            ))
+        await asyncio.wait_for(asyncio.gather(*watchers), timeout=1)
+        return updates
+
+    async def test_progress_of_own_task(self):
+        updates = await self.concurrent_progress(FakeSDServer(delay=0.2, serial=True))
+
+        # Neither saw the other's progress, which would show up as going backwards
+        for seen in updates:
+            fractions = [update.fraction for update in seen]
+            self.assertGreater(len(fractions), 3)
+            self.assertEqual(fractions, sorted(fractions))
+            self.assertTrue(any(update.preview for update in seen))
+
+    async def test_progress_without_tasks(self):
+        updates = await self.concurrent_progress(FakeSDServer(delay=0.2, serial=True, task_progress=False))
+
+        # The backend's overall progress is only trusted with one call in flight
+        for seen in updates:
+            fractions = [update.fraction for update in seen]
+            self.assertEqual(fractions, sorted(fractions))
+        self.assertGreater(len(updates[1]), 3)
+        self.assertTrue(any(update.preview for update in updates[1]))
+
+    async def test_progress_coalesces(self):
+        feed = generation.ProgressFeed()
+        for fraction in (0.1, 0.2, 0.3):
+            feed.publish(generation.Progress(fraction, None))
+        iterator = aiter(feed)
+        self.assertEqual((await anext(iterator)).fraction, 0.3)
+        feed.close()
+        with self.assertRaises(StopAsyncIteration):
+            await anext(iterator)
+
+    def test_json_body(self):
+        payload = dict(prompt='a "frog"', steps=20, init_images=[b'AAAA', b'BBBB'])
+        body = b''.join(generation.json_body(payload))
+        self.assertEqual(json.loads(body), dict(payload, init_images=['data:image/png;base64,AAAA', 'data:image/png;base64,BBBB']))
+        self.assertEqual(json.loads(b''.join(generation.json_body(dict(init_images=[b'AAAA'])))), dict(init_images=['data:image/png;base64,AAAA']))
+        self.assertEqual(json.loads(b''.join(generation.json_body(dict(prompt='a frog')))), dict(prompt='a frog'))
+
+    def test_decode_response(self):
+        images = [png_b64(8, 8), png_b64(4, 4, (1, 2, 3))]
+        info = json.dumps(dict(seed=5, prompt='"images": [ a trap ]'))
+        expected = [base64.b64decode(data) for data in images]
+
+        for body in [
+            json.dumps(dict(images=images, parameters={}, info=info)),
+            json.dumps(dict(info=info, images=images), indent=2),
+            json.dumps(dict(images=['data:image/png;base64,' + images[0], images[1]], info=info)),
+            json.dumps(dict(images=[image.replace('/', '\\/') for image in images], info=info)),
+            json.dumps(dict(parameters=dict(images=['AAAA']), info=info, images=images)),
+            json.dumps(dict(parameters=[{'images': []}], images=images, info=info)),
+        ]:
+            decoded, rest = generation.decode_response(body.encode())
+            self.assertEqual(decoded, expected, body[:40])
+            self.assertEqual(json.loads(rest['info'])['seed'], 5)
+            self.assertNotIn('images', rest)
+
+        self.assertEqual(generation.decode_response(b'{"images": [], "info": "{}"}'), ([], dict(info='{}')))
+
+        # A span a2b_base64 cannot take goes through json, which reports it
+        with self.assertRaises(ValueError):
+            generation.decode_response(json.dumps(dict(images=['AAA'], info=info)).encode())
+
+    async def test_render_in_process(self):
+        render = functools.partial(
+            generation.render_image, base64.b64decode(png_b64(96, 64)), prompt='a frog, in a pond', width=96, height=64,
+            resize_dimensions=(48, 32), palette='AAAA____',
+        )
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            with mock.patch.object(generation, '_render_executor', executor):
+                rendered = await generation.run_render(render)
+        self.assertEqual(rendered, render())
+        self.assertTrue(rendered[1].startswith('a-frog-in-a-pond-'))
+
+    def test_render_resample(self):
+        raw_image = base64.b64decode(png_b64(96, 64))
+        with mock.patch.object(generation.image, 'quantize', wraps=generation.image.quantize) as quantize:
+            data, _ = generation.render_image(raw_image, 'a frog', 96, 64, overlay=False, resize_dimensions=(16, 16), palette='AAAA____')
+            self.assertEqual(quantize.call_args.args[0].size, (96, 64))
+
+            # With a filter the palette is applied after resizing
+            data, _ = generation.render_image(
+                raw_image, 'a frog', 96, 64, overlay=False, resize_dimensions=(16, 16), palette='AAAA____', resample='box')
+            self.assertEqual(quantize.call_args.args[0].size, (16, 16))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (16, 16))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+import collections
+import os
+import random
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+from stabby import conf, grammar
+from tests.helpers import with_params
+
+
+SHIPPED_GRAMMARS = [
+    ('karma_grammar.txt', 'ROOT'),
+    ('prompt_grammar.txt', 'ROOT'),
+    ('maker_grammar.txt', 'Subject'),
+    ('maker_grammar.txt', 'Environment'),
+    ('maker_grammar.txt', 'Style'),
+]
+
+
+RUNAWAY_GRAMMAR = """
+1 ROOT NP
+1 NP NP PP
+.01 NP N
+1 PP P NP
+1 N cat
+1 N dog
+1 P with
+"""
+
+
+def write_grammar(test: unittest.TestCase, text: str) -> str:
+    handle, path = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(handle, 'w') as file:
+        file.write(text)
+    test.addCleanup(os.remove, path)
+    return path
+
+
+def legacy_generate(language: grammar.Grammar, start='ROOT') -> str:
+    # The original rule-scanning implementation, kept as a reference for the compiled tables
+    def sentence_generator(symbol, sentence):
+        rand_count = {}
+        if symbol not in language.non_terminal.keys():
+            sentence.append(symbol)
+        else:
+            total_count = float(language.non_terminal[symbol])
+            current_count = 0.0
+            for rule in language.rules:
+                if rule[1] == symbol:
+                    current_count = current_count + float(rule[0]) / total_count
+                    rand_count[current_count] = rule
+            r = random.random()
+            apply_rule = []
+            for prob in sorted(rand_count.keys()):
+                if prob >= r:
+                    apply_rule = rand_count[prob]
+                    break
+            for s in apply_rule[2:len(apply_rule)]:
+                sentence_generator(s, sentence)
+
+    sentence: list = []
+    sentence_generator(start, sentence)
+    return legacy_join(sentence)
+
+
+def legacy_join(sentence: list) -> str:
+    # The original regex based cleanup, kept as a reference for the single pass joiner
+    text = ' '.join(sentence)
+    text = re.sub(r',(\s*,)+', ',', text)
+    text = re.sub(r'[,]+', ',', text)
+    text = re.sub(r'([\[({])\s+', r'\1', text)
+    text = re.sub(r'\s+([\])},])', r'\1', text)
+    text = re.sub(r'([\w\d])\s+([^\w\d])', r'\1\2', text)
+    text = re.sub(r'[ ]+', ' ', text)
+    return text
+
+
+class TestGrammar(unittest.TestCase):
+
+    @with_params('Shipped grammars', SHIPPED_GRAMMARS)
+    def test_matches_legacy_sampling(self, filename, start):
+        language = grammar.Grammar(filename)
+        for seed in range(50):
+            random.seed(seed)
+            expected = legacy_generate(language, start=start)
+            random.seed(seed)
+            self.assertEqual(language.generate(start=start), expected)
+
+    @with_params('Shipped grammars', SHIPPED_GRAMMARS)
+    def test_compiled_probabilities(self, filename, start):
+        language = grammar.Grammar(filename)
+        for symbol, (probabilities, expansions) in language.productions.items():
+            self.assertEqual(len(probabilities), len(expansions))
+            self.assertEqual(list(probabilities), sorted(probabilities))
+            self.assertAlmostEqual(probabilities[-1], 1.0)
+
+    def test_terminal_start(self):
+        language = grammar.Grammar('karma_grammar.txt')
+        self.assertEqual(language.generate(start='not-a-symbol'), 'not-a-symbol')
+
+    def test_cheapest_fallback(self):
+        language = grammar.Grammar(write_grammar(self, RUNAWAY_GRAMMAR))
+        self.assertEqual(language.fallbacks['NP'], ('N',))
+        self.assertEqual(language.fallbacks['PP'], ('P', 'NP'))
+        self.assertEqual(language.fallbacks['N'], ('cat',))
+
+    def test_depth_limit(self):
+        language = grammar.Grammar(write_grammar(self, RUNAWAY_GRAMMAR), max_depth=6, max_tokens=10000)
+        for seed in range(50):
+            random.seed(seed)
+            text = language.generate()
+            self.assertLess(len(text.split()), 2 ** 6)
+
+    def test_token_limit(self):
+        language = grammar.Grammar(write_grammar(self, RUNAWAY_GRAMMAR), max_depth=40, max_tokens=20)
+        for seed in range(50):
+            random.seed(seed)
+            # Once the budget is spent, everything still on the stack takes its cheapest production
+            self.assertLessEqual(len(language.generate().split()), 20 + 2 * 40)
+            self.assertLessEqual(len(language.generate(max_tokens=5).split()), 5 + 2 * 40)
+
+    def test_unterminated_symbol(self):
+        language = grammar.Grammar(write_grammar(self, "1 ROOT a LOOP b\n1 LOOP LOOP LOOP\n"), max_depth=3)
+        self.assertNotIn('LOOP', language.fallbacks)
+        self.assertEqual(language.generate(), 'a b')
+
+    @with_params('Batch sizes', [(1,), (5,), (grammar.BATCH_THRESHOLD,), (200,)])
+    def test_generate_many(self, n):
+        language = grammar.Grammar('maker_grammar.txt')
+        prompts = language.generate_many(n, start='Subject', seed=1)
+        self.assertEqual(len(prompts), n)
+        self.assertEqual(prompts, language.generate_many(n, start='Subject', seed=1))
+        self.assertTrue(all(prompts))
+        self.assertEqual(language.generate_many(n, start='not-a-symbol'), ['not-a-symbol'] * n)
+
+    def test_generate_many_distribution(self):
+        language = grammar.Grammar(write_grammar(self, "1 ROOT a X\n3 ROOT b\n1 X\n1 X c\n"))
+        counts = collections.Counter(language.generate_many(8000, seed=3))
+        self.assertEqual(set(counts), {'a', 'a c', 'b'})
+        self.assertAlmostEqual(counts['b'] / 8000, 0.75, delta=0.03)
+        self.assertAlmostEqual(counts['a c'] / 8000, 0.125, delta=0.02)
+
+    def test_generate_many_limits(self):
+        language = grammar.Grammar(write_grammar(self, RUNAWAY_GRAMMAR), max_depth=6, max_tokens=10000)
+        for text in language.generate_many(500, seed=4):
+            self.assertLess(len(text.split()), 2 ** 6)
+
+    def test_cache_roundtrip(self):
+        path = write_grammar(self, RUNAWAY_GRAMMAR)
+        self.addCleanup(os.remove, path + grammar.CACHE_SUFFIX)
+
+        compiled = grammar.Grammar.load(path)
+        self.assertTrue(os.path.exists(path + grammar.CACHE_SUFFIX))
+
+        with mock.patch.object(grammar.Grammar, '__init__', side_effect=AssertionError('parsed again')):
+            cached = grammar.Grammar.load(path, max_depth=7)
+            self.assertEqual(cached.productions, compiled.productions)
+            self.assertEqual(cached.fallbacks, compiled.fallbacks)
+            self.assertEqual(cached.max_depth, 7)
+
+            # A new mtime with the same content is still a hit
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            grammar.Grammar.load(path)
+
+        with open(path, 'a') as file:
+            file.write("1 N bird\n")
+        changed = grammar.Grammar.load(path)
+        self.assertIn(('bird',), changed.productions['N'][1])
+
+    def test_cache_version(self):
+        path = write_grammar(self, RUNAWAY_GRAMMAR)
+        self.addCleanup(os.remove, path + grammar.CACHE_SUFFIX)
+
+        with mock.patch.object(grammar, 'CACHE_VERSION', grammar.CACHE_VERSION - 1):
+            grammar.Grammar.load(path)
+
+        # A cache written with an older layout is parsed again rather than loaded
+        with self.assertLogs(grammar.logger, 'INFO') as logs:
+            language = grammar.Grammar.load(path)
+        self.assertIn('Compiling grammar', logs.output[0])
+        self.assertIsInstance(language.rules, tuple)
+
+    def test_cache_dir(self):
+        path = write_grammar(self, RUNAWAY_GRAMMAR)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            grammar.Grammar.load(path, cache_dir=cache_dir)
+            self.assertFalse(os.path.exists(path + grammar.CACHE_SUFFIX))
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            for cache_file in os.listdir(cache_dir):
+                with open(os.path.join(cache_dir, cache_file), 'wb') as file:
+                    file.write(b'not a pickle')
+
+            with self.assertLogs(grammar.logger, 'WARNING'):
+                language = grammar.Grammar.load(path, cache_dir=cache_dir)
+            self.assertIn('NP', language.productions)
+
+    def test_registry(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            config = conf.load_conf().model_copy(update=dict(
+                karma_grammar='karma_grammar.txt',
+                maker_grammar=write_grammar(self, RUNAWAY_GRAMMAR),
+                grammar_cache_dir=cache_dir,
+                grammar_max_depth=5,
+            ))
+            registry = grammar.GrammarRegistry(config)
+
+            with mock.patch.object(grammar, 'load_grammar', wraps=grammar.load_grammar) as loader:
+                maker = registry.get('maker')
+                self.assertIs(registry.get('maker'), maker)
+                self.assertEqual(loader.call_count, 1)
+                self.assertEqual(maker.max_depth, 5)
+
+            self.assertEqual(registry.reload('maker'), ['maker'])
+            self.assertIsNot(registry.get('maker'), maker)
+            self.assertEqual(registry.get('maker').productions, maker.productions)
+
+            with self.assertRaises(KeyError):
+                registry.get('missing')
+
+    @with_params('Shipped grammars', SHIPPED_GRAMMARS)
+    def test_join_matches_legacy(self, filename, start):
+        language = grammar.Grammar(filename)
+        terminals = sorted({symbol for rule in language.rules for symbol in rule[2:] if symbol not in language.productions})
+        punctuation = [',', ',,', '(', ')', '[', ']', '{', '}', '),', '(,', ',)', ':', '-', '|', '.', "'s", '_', '1.5']
+        rand = random.Random(filename + start)
+        for _ in range(2000):
+            sentence = rand.choices(terminals, k=rand.randint(0, 12)) + rand.choices(punctuation, k=rand.randint(0, 8))
+            rand.shuffle(sentence)
+            self.assertEqual(language._join(sentence), legacy_join(sentence), sentence)
+
+        for _ in range(200):
+            sentence: list = []
+            language._sentence_generator(start, sentence)
+            self.assertEqual(language._join(sentence), legacy_join(sentence))
+
+    def test_analyze(self):
+        language = grammar.Grammar(write_grammar(self, "\n".join([
+            "1 ROOT a X",
+            "1 ROOT b",
+            "3 X c",
+            "1 X X X",
+            "1 ORPHAN MISSING_RULE",
+        ])))
+        self.assertEqual(language.root_symbols(), ['ROOT', 'ORPHAN'])
+
+        analysis = language.analyze(starts=['ROOT'], max_depth=2)
+        (root,) = analysis.symbols
+        self.assertAlmostEqual(root.expected_expansions, 2.0)
+        self.assertAlmostEqual(root.expected_length, 1.75)
+        # Only ROOT -> a X -> X X runs into the limit: 1/2 * 1/4
+        self.assertAlmostEqual(root.depth_limit_probability, 0.125)
+        self.assertEqual(analysis.unreachable, ['ORPHAN'])
+        self.assertEqual(analysis.undefined, [])
+
+        analysis = language.analyze()
+        self.assertEqual(analysis.unreachable, [])
+        self.assertEqual(analysis.undefined, ['MISSING_RULE'])
+
+    def test_analyze_runaway(self):
+        language = grammar.Grammar(write_grammar(self, RUNAWAY_GRAMMAR))
+        (root,) = language.analyze().symbols
+        self.assertEqual(root.expected_expansions, float('inf'))
+        self.assertEqual(root.expected_length, float('inf'))
+        self.assertGreater(root.depth_limit_probability, 0.5)
+
+    def test_analyze_isolates_runaway(self):
+        language = grammar.Grammar(write_grammar(self, "1 ROOT a\n1 LOOP LOOP LOOP\n1 LOOP b\n"))
+        root, loop = language.analyze(starts=['ROOT', 'LOOP']).symbols
+        self.assertEqual((root.expected_expansions, root.expected_length), (1.0, 1.0))
+        self.assertEqual(loop.expected_expansions, float('inf'))
+
+    def test_benchmark(self):
+        language = grammar.Grammar('maker_grammar.txt')
+        for batched in (False, True):
+            result = language.benchmark('Subject', 50, batched=batched)
+            self.assertEqual(result.count, 50)
+            self.assertGreater(result.prompts_per_second, 0)
+            self.assertGreater(result.peak_bytes_per_prompt, 0)
+
+    def test_recent_filter(self):
+        recent = grammar.RecentFilter(3)
+        self.assertTrue(recent.admit('a'))
+        self.assertFalse(recent.admit('a'))
+        for text in 'bcd':
+            self.assertTrue(recent.admit(text))
+        # 'a' has been pushed out of the window of three
+        self.assertNotIn('a', recent)
+        self.assertTrue(recent.admit('a'))
+        self.assertEqual((recent.checks, recent.hits), (6, 1))
+        self.assertLessEqual(len(recent._counts), 3)
+
+    def test_generate_avoids_recent(self):
+        language = grammar.Grammar(write_grammar(self, "1 ROOT a\n1 ROOT b\n1 ROOT c\n"))
+        recent = grammar.RecentFilter(2)
+        random.seed(5)
+        outputs = [language.generate(recent=recent, retries=50) for _ in range(30)]
+        for first, second, third in zip(outputs, outputs[1:], outputs[2:]):
+            self.assertEqual(len({first, second, third}), 3)
@@ -0,0 +1,66 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+from discord import File
+
+from stabby import handlers
+
+
+class TestHandlers(unittest.IsolatedAsyncioTestCase):
+
+    async def test_prompt_stream(self):
+        client = handlers.app.test_client()
+        response = await client.get('/api/prompts', query_string=dict(n=130, subject='a frog'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+
+        lines = (await response.get_data(as_text=True)).splitlines()
+        self.assertEqual(len(lines), 130)
+        for line in lines:
+            self.assertTrue(json.loads(line)['prompt'].startswith('a frog '))
+
+    async def test_prompt_stream_start_symbol(self):
+        client = handlers.app.test_client()
+        response = await client.get('/api/prompts', query_string=dict(n=5, grammar='karma', start='ROOT'))
+        lines = (await response.get_data(as_text=True)).splitlines()
+        self.assertEqual(len(lines), 5)
+
+    async def test_prompt_stream_errors(self):
+        client = handlers.app.test_client()
+        for query in [dict(grammar='missing'), dict(n='lots'), dict(n=0), dict(n=handlers.config.prompt_stream_max + 1),
+                      dict(grammar='karma', start='typo'), dict(grammar='karma', subject='a frog'),
+                      dict(start='Subject', subject='a frog')]:
+            response = await client.get('/api/prompts', query_string=query)
+            self.assertEqual(response.status_code, 400, query)
+
+    async def test_generate_rejects_unknown_quantizer(self):
+        client = handlers.app.test_client()
+        response = await client.get('/api/generate', query_string=dict(prompt='a frog', quantizer='sparkly'))
+        self.assertEqual(response.status_code, 400)
+
+    async def test_generate_rejects_bad_resizing(self):
+        client = handlers.app.test_client()
+        for query in [dict(resample='blurry'), dict(reducing_gap='wide'), dict(reducing_gap='0.5'), dict(reducing_gap='nan')]:
+            response = await client.get('/api/generate', query_string=dict(prompt='a frog', **query))
+            self.assertEqual(response.status_code, 400, query)
+
+    async def test_generate_cached(self):
+        client = handlers.app.test_client()
+        cached = (File(io.BytesIO(b'cached image'), filename='a-frog.png'), {})
+        # A cached result is served even while the queue is full
+        with mock.patch.object(handlers.generation, 'cached_result', mock.AsyncMock(return_value=cached)), \
+                mock.patch.object(handlers.jobs.JobQueue, 'submit', side_effect=handlers.jobs.QueueFull('busy')):
+            response = await client.get('/api/generate', query_string=dict(prompt='a frog'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await response.get_data(), b'cached image')
+
+    async def test_metrics(self):
+        client = handlers.app.test_client()
+        response = await client.get('/api/metrics')
+        metrics = await response.get_json()
+        self.assertIn('maker:random', metrics['prompt_pool'])
+        self.assertIn('hit_rate', metrics['recent_filter'])
+        self.assertIn('backend-0', metrics['backends'])
+        self.assertNotIn('://', json.dumps(metrics['backends']))
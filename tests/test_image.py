@@ -0,0 +1,238 @@
+import base64
+import io
+import itertools
+import math
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from stabby import image
+
+
+PALETTE = base64.urlsafe_b64encode(bytes([
+    0, 0, 0,
+    255, 255, 255,
+    255, 0, 0,
+    0, 0, 255,
+])).decode()
+
+
+def gradient(width: int = 64, height: int = 32) -> Image.Image:
+    xs = np.linspace(0, 255, width, dtype=np.uint8)
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    pixels[..., 0] = xs
+    pixels[..., 2] = xs[::-1]
+    return Image.fromarray(pixels)
+
+
+class TestClosestDimensions(unittest.TestCase):
+
+    def brute_force(self, table: image.AspectTable, width: int, height: int) -> tuple[int, int]:
+        aspect = math.atan(height / width)
+        return min(table.entries, key=lambda entry: abs(aspect - entry[0]))[1]
+
+    def test_matches_brute_force(self):
+        table = image.AspectTable(image.SDXL_RESOLUTIONS)
+        for width in range(1, 3000, 7):
+            for height in (1, 333, 512, 1024, 1399, 4096):
+                self.assertEqual(table.closest(width, height), self.brute_force(table, width, height))
+                self.assertEqual(table.closest(height, width), self.brute_force(table, height, width))
+        self.assertEqual(image.get_closest_dimensions(1920, 1080), (1344, 768))
+
+    def test_custom_table(self):
+        table = image.AspectTable([(512, 512), (768, 512), (1024, 1024)])
+        self.assertEqual(table.closest(1000, 1000), (512, 512))
+        self.assertEqual(table.closest(1920, 1080), (768, 512))
+        self.assertEqual(table.closest(300, 1000), (512, 768))
+
+
+class TestTitle(unittest.TestCase):
+
+    def title_font(self, title: str, width: int = 1024) -> tuple[int, int]:
+        with mock.patch.object(ImageDraw.ImageDraw, 'text') as draw_text:
+            image.add_text_to_image(Image.new('RGBA', (width, width)), width, width, title, 'by someone')
+        font, outline = draw_text.call_args_list[0].kwargs['font'], draw_text.call_args_list[0].kwargs['stroke_width']
+        return font.size, outline
+
+    def test_fitting(self):
+        self.assertEqual(self.title_font('a frog'), (25, 4))
+
+        title = 'a frog in a castle ' * 4
+        size, outline = self.title_font(title)
+        font = ImageFont.truetype(image.config.title_font, size=size)
+        larger = ImageFont.truetype(image.config.title_font, size=size + 1)
+        self.assertLess(15, size)
+        self.assertLessEqual(font.getlength(title), 1024)
+        self.assertGreater(larger.getlength(title), 1024)
+        # Sized from one point below the font, like the old one size at a time loop did
+        self.assertEqual(outline, max(2, min((size - 1) // 5, 4)))
+
+        # Nothing fits, so the title stops one point above the artist
+        self.assertEqual(self.title_font(title * 10), (16, 3))
+
+    def test_fonts_cached(self):
+        image.load_font.cache_clear()
+        with mock.patch.object(ImageFont, 'truetype', wraps=ImageFont.truetype) as truetype:
+            self.title_font('a frog in a castle ' * 6)
+            loads = truetype.call_count
+            self.title_font('a frog in a castle ' * 7)
+        self.assertLessEqual(loads, 6)
+        self.assertLessEqual(truetype.call_count, loads + 4)
+
+
+class TestOverlay(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(image, '_overlay_cache', image.OverlayCache(max_bytes=1024 * 1024))
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def noise(self, mode: str = 'RGB') -> Image.Image:
+        pixels = np.random.default_rng(0).integers(0, 256, (256, 320, 3), dtype=np.uint8)
+        return Image.fromarray(pixels).convert(mode)
+
+    def test_layer_matches_drawing(self):
+        drawn = self.noise()
+        image.add_text_to_image(drawn, 256, 320, 'a frog in a castle', 'by someone')
+        for _ in range(3):
+            pasted = self.noise()
+            image.draw_overlay(pasted, 256, 320, 'a frog in a castle', 'by someone')
+            difference = np.abs(np.asarray(drawn, dtype=np.int16) - np.asarray(pasted, dtype=np.int16))
+            self.assertLessEqual(difference.max(), 1)
+
+        # Drawn directly the first time, then rendered as a layer and reused
+        self.assertEqual(self.cache.stats()['entries'], 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_budget(self):
+        self.cache.max_bytes = image.layer_bytes(image.render_overlay((320, 256), 256, 320, 'a frog', None)[1]) + 1
+        for title in ('a frog', 'a frog', 'a toad', 'a toad'):
+            image.draw_overlay(self.noise(), 256, 320, title, None)
+        self.assertEqual((self.cache.stats()['entries'], self.cache.evictions), (1, 1))
+
+    def test_palette_drawn_directly(self):
+        drawn, pasted = self.noise('P'), self.noise('P')
+        image.add_text_to_image(drawn, 256, 320, 'a frog', 'by someone')
+        for _ in range(2):
+            image.draw_overlay(pasted, 256, 320, 'a frog', 'by someone')
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+        pasted = self.noise('P')
+        image.draw_overlay(pasted, 256, 320, 'a frog', 'by someone')
+        self.assertEqual(drawn.tobytes(), pasted.tobytes())
+
+
+class TestResize(unittest.TestCase):
+
+    def test_default_unchanged(self):
+        source = gradient(64, 32)
+        self.assertEqual(image.resize(source, (16, 8)).tobytes(), source.resize((16, 8)).tobytes())
+
+    def test_box_reduces(self):
+        source = gradient(64, 32)
+        with mock.patch.object(Image.Image, 'reduce', wraps=source.reduce) as reduce:
+            reduced = image.resize(source, (16, 16), 'box')
+        reduce.assert_called_once_with((4, 2))
+        boxed = np.asarray(source.resize((16, 16), Image.Resampling.BOX), dtype=np.int16)
+        self.assertLessEqual(np.abs(np.asarray(reduced, dtype=np.int16) - boxed).max(), 1)
+
+        # Not a whole factor, so an ordinary resize
+        self.assertEqual(image.resize(source, (24, 16), 'box').tobytes(), source.resize((24, 16), Image.Resampling.BOX).tobytes())
+
+    def test_filter_and_gap(self):
+        source = gradient(256, 128)
+        resized = image.resize(source, (32, 16), 'lanczos', reducing_gap=2.0)
+        self.assertEqual(resized.tobytes(), source.resize((32, 16), Image.Resampling.LANCZOS, reducing_gap=2.0).tobytes())
+
+
+class TestPrepareInput(unittest.TestCase):
+
+    def decode(self, encoded: bytes) -> Image.Image:
+        return Image.open(io.BytesIO(base64.b64decode(encoded, validate=True)))
+
+    def encode(self, source: Image.Image, format: str) -> bytes:
+        with io.BytesIO() as output:
+            source.save(output, format=format)
+            return output.getvalue()
+
+    def test_shrinks_to_generation_size(self):
+        source = Image.new('RGB', (1600, 1200), (10, 120, 200))
+        prepared = self.decode(image.prepare_input(self.encode(source, 'JPEG'), 640, 480))
+        self.assertEqual((prepared.size, prepared.mode), ((640, 480), 'RGB'))
+        self.assertTrue(all(abs(a - b) <= 2 for a, b in zip(prepared.getpixel((320, 240)), (10, 120, 200))))
+
+    def test_small_source_kept(self):
+        source = Image.new('P', (32, 16))
+        source.putpalette([255, 0, 0] * 256)
+        prepared = self.decode(image.prepare_input(self.encode(source, 'PNG'), 640, 480))
+        self.assertEqual((prepared.size, prepared.mode), ((32, 16), 'RGB'))
+        self.assertEqual(prepared.getpixel((0, 0)), (255, 0, 0))
+
+
+class TestBase64(unittest.TestCase):
+
+    def test_writer(self):
+        data = bytes(range(256)) * 3
+        for sizes in ([1, 1, 1, 5], [2, 2, 2, 2, 2], [768], [3, 4, 5, 7, 11]):
+            output = bytearray()
+            with image.Base64Writer(output) as writer:
+                offset = 0
+                for size in itertools.cycle(sizes):
+                    if offset >= len(data):
+                        break
+                    writer.write(memoryview(data)[offset:offset + size])
+                    offset += size
+            self.assertEqual(bytes(output), base64.b64encode(data))
+
+    def test_raw_b64_img(self):
+        source = gradient()
+        source.info['parameters'] = 'a frog'
+        decoded = Image.open(io.BytesIO(base64.b64decode(image.raw_b64_img(source))))
+        self.assertEqual(decoded.tobytes(), source.tobytes())
+        self.assertEqual(decoded.info['parameters'], 'a frog')
+
+
+class TestQuantize(unittest.TestCase):
+
+    def test_palette_cache(self):
+        self.assertIs(image.palette_image(PALETTE), image.palette_image(PALETTE))
+        self.assertIs(image.palette_lookup(PALETTE), image.palette_lookup(PALETTE))
+
+    def test_pil_unchanged(self):
+        source = gradient()
+        reference = Image.new('P', (1, 1))
+        reference.putpalette(list(base64.urlsafe_b64decode(PALETTE)))
+        expected = source.convert('RGB').quantize(palette=reference)
+        self.assertEqual(image.quantize(source, PALETTE).tobytes(), expected.tobytes())
+
+    def test_nearest(self):
+        colors = np.frombuffer(base64.urlsafe_b64decode(PALETTE), dtype=np.uint8).reshape(-1, 3).astype(int)
+        source = gradient()
+        quantized = image.quantize(source, PALETTE, 'nearest')
+        self.assertEqual(quantized.mode, 'P')
+        self.assertEqual(quantized.size, source.size)
+
+        pixels = np.asarray(source).reshape(-1, 1, 3).astype(int)
+        exact = ((pixels - colors[None]) ** 2).sum(axis=2).argmin(axis=1)
+        # The lookup table works at six bits per channel, so only near ties can differ
+        self.assertGreater((np.asarray(quantized).reshape(-1) == exact).mean(), 0.97)
+
+        self.assertEqual(np.asarray(image.quantize(Image.fromarray(colors.astype(np.uint8)[None]), PALETTE, 'nearest')).tolist(), [[0, 1, 2, 3]])
+
+    def test_ordered(self):
+        quantized = image.quantize(gradient(), PALETTE, 'ordered')
+        indices = np.asarray(quantized)
+        self.assertLessEqual(set(np.unique(indices)), {0, 1, 2, 3})
+        # Dithering mixes colours across a gradient where nearest would give bands
+        nearest = np.asarray(image.quantize(gradient(), PALETTE, 'nearest'))
+        self.assertGreater(len(np.unique(indices[:, 30:34])), len(np.unique(nearest[:, 30:34])))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            image.quantize(gradient(), PALETTE, 'sparkly')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from stabby import jobs
+
+
+class FakeRunner:
+
+    def __init__(self) -> None:
+        self.running = 0
+        self.peak = 0
+        self.started: list[dict] = []
+        self.release = asyncio.Event()
+
+    async def __call__(self, params: dict):
+        self.started.append(params)
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await self.release.wait()
+            if params.get('fail'):
+                raise RuntimeError('backend exploded')
+            if params.get('cancel'):
+                raise asyncio.CancelledError()
+            return params['n'], {}
+        finally:
+            self.running -= 1
+
+
+class TestJobQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def test_worker_limit(self):
+        runner = FakeRunner()
+        queue = jobs.JobQueue(workers=2, max_depth=10, runner=runner)
+        submitted = [queue.submit(dict(n=n)) for n in range(5)]
+
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(runner.started), 2)
+        self.assertEqual(queue.stats()['waiting'], 3)
+
+        runner.release.set()
+        results = await asyncio.gather(*submitted)
+        self.assertEqual([result for result, _ in results], list(range(5)))
+        self.assertEqual(runner.peak, 2)
+        self.assertEqual(queue.stats()['completed'], 5)
+
+    async def test_growing_workers(self):
+        runner = FakeRunner()
+        workers = [1]
+        queue = jobs.JobQueue(workers=lambda: workers[0], max_depth=10, runner=runner)
+        submitted = [queue.submit(dict(n=n)) for n in range(3)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(runner.started), 1)
+
+        # Say a backend was added, the next submission brings in another worker
+        workers[0] = 2
+        submitted.append(queue.submit(dict(n=3)))
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(runner.started), 2)
+
+        runner.release.set()
+        await asyncio.gather(*submitted)
+        self.assertEqual(runner.peak, 2)
+
+    async def test_positions(self):
+        runner = FakeRunner()
+        queue = jobs.JobQueue(workers=1, max_depth=10, runner=runner)
+        first = queue.submit(dict(n=0))
+        # Nothing is running yet, so the first job goes straight to the idle worker
+        self.assertEqual(first.position, 0)
+
+        await asyncio.sleep(0.01)
+        second = queue.submit(dict(n=1))
+        third = queue.submit(dict(n=2))
+        self.assertEqual((first.position, second.position, third.position), (0, 1, 2))
+
+        runner.release.set()
+        await asyncio.gather(first, second, third)
+        self.assertEqual(third.position, 0)
+
+    async def test_backpressure(self):
+        runner = FakeRunner()
+        queue = jobs.JobQueue(workers=1, max_depth=2, runner=runner)
+        submitted = [queue.submit(dict(n=0))]
+        await asyncio.sleep(0.01)
+        submitted += [queue.submit(dict(n=n)) for n in (1, 2)]
+
+        with self.assertRaises(jobs.QueueFull):
+            queue.submit(dict(n=3))
+        self.assertEqual(queue.stats()['rejected'], 1)
+
+        runner.release.set()
+        await asyncio.gather(*submitted)
+        await queue.submit(dict(n=4))
+
+    async def test_failure(self):
+        runner = FakeRunner()
+        runner.release.set()
+        queue = jobs.JobQueue(workers=1, max_depth=10, runner=runner)
+
+        with self.assertRaises(RuntimeError):
+            await queue.submit(dict(n=0, fail=True))
+
+        with self.assertRaises(asyncio.CancelledError):
+            await queue.submit(dict(n=1, cancel=True))
+
+        # The worker survives and keeps serving the queue
+        result, _ = await queue.submit(dict(n=2))
+        self.assertEqual(result, 2)
+        self.assertEqual((queue.stats()['failed'], queue.stats()['completed']), (2, 1))
+
+    async def test_batching(self):
+        runner = FakeRunner()
+        batches: list[list[dict]] = []
+
+        async def batch_runner(batch):
+            batches.append(batch)
+            return [(params['n'], {}) for params in batch]
+
+        queue = jobs.JobQueue(
+            workers=1, max_depth=10, runner=runner, batch_runner=batch_runner,
+            batch_key=lambda params: params.get('key'), batch_max=3,
+        )
+        blocker = queue.submit(dict(n=0))
+        await asyncio.sleep(0.01)
+        waiting = [queue.submit(dict(n=n, key=key)) for n, key in enumerate('aabaa', start=1)]
+
+        runner.release.set()
+        results = await asyncio.gather(blocker, *waiting)
+        self.assertEqual([result for result, _ in results], list(range(6)))
+        # Up to three jobs with the same key share a call, the rest run as they come
+        self.assertEqual([[params['n'] for params in batch] for batch in batches], [[1, 2, 4]])
+        self.assertEqual([params['n'] for params in runner.started], [0, 3, 5])
+        self.assertEqual((queue.stats()['batches'], queue.stats()['batched']), (1, 3))
+
+    async def test_short_batch(self):
+        async def batch_runner(batch):
+            return [(params['n'], {}) for params in batch[:1]]
+
+        runner = FakeRunner()
+        queue = jobs.JobQueue(
+            workers=1, max_depth=10, runner=runner, batch_runner=batch_runner,
+            batch_key=lambda params: params.get('key'), batch_max=3,
+        )
+        blocker = queue.submit(dict(n=0))
+        await asyncio.sleep(0.01)
+        waiting = [queue.submit(dict(n=n, key='a')) for n in range(1, 4)]
+        runner.release.set()
+        await blocker
+
+        self.assertEqual((await waiting[0])[0], 1)
+        for job in waiting[1:]:
+            with self.assertRaises(jobs.GenerationError):
+                await asyncio.wait_for(job, 1)
+        self.assertEqual((queue.stats()['completed'], queue.stats()['failed']), (2, 2))
+
+    async def test_worker_respawn(self):
+        runner = FakeRunner()
+        runner.release.set()
+        queue = jobs.JobQueue(workers=1, max_depth=10, runner=runner)
+
+        with self.assertLogs(jobs.logger, 'ERROR'):
+            with mock.patch.object(jobs.asyncio, 'wait', side_effect=[RuntimeError('worker broke'), mock.DEFAULT], wraps=asyncio.wait):
+                first = queue.submit(dict(n=0))
+                second = queue.submit(dict(n=1))
+                with self.assertRaises(asyncio.CancelledError):
+                    await first
+                # A replacement worker picks up the job that was already waiting
+                result, _ = await asyncio.wait_for(second, timeout=1)
+
+        self.assertEqual(result, 1)
+        self.assertEqual(len(queue._tasks), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
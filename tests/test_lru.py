@@ -0,0 +1,43 @@
+import threading
+import unittest
+
+from stabby import lru
+
+
+class TestByteLRU(unittest.TestCase):
+
+    def test_budget(self):
+        cache = lru.ByteLRU(max_bytes=25)
+        cache.put('a', b'a' * 10)
+        cache.put('b', b'b' * 10)
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        cache.put('c', b'c' * 10)
+
+        # 'b' was the least recently used once 'a' was read
+        self.assertIsNone(cache.get('b'))
+        cache.put('a', b'a' * 5)
+        cache.put('huge', b'x' * 100)
+        self.assertIsNone(cache.get('huge'))
+        self.assertEqual(cache.stats(), dict(entries=2, bytes=15, hits=1, misses=2, evictions=1))
+
+    def test_size(self):
+        cache = lru.ByteLRU(max_bytes=10, size=lambda value: value[1])
+        cache.put('a', ('a', 6))
+        cache.put('b', ('b', 6))
+        self.assertEqual((len(cache), cache.bytes, cache.evictions), (1, 6, 1))
+
+    def test_threads(self):
+        cache = lru.ByteLRU(max_bytes=64)
+
+        def churn(offset: int) -> None:
+            for idx in range(2000):
+                cache.put((offset + idx) % 50, b'x' * (idx % 8 + 1))
+                cache.get((offset + idx * 7) % 50)
+
+        threads = [threading.Thread(target=churn, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.bytes, sum(len(value) for value in cache._entries.values()))
+        self.assertLessEqual(cache.bytes, 64)
@@ -0,0 +1,95 @@
+import asyncio
+import itertools
+import unittest
+
+from stabby import grammar, prompts
+
+
+def counting_source():
+    counter = itertools.count()
+
+    def source(count: int) -> list[str]:
+        return [str(next(counter)) for _ in range(count)]
+    return source
+
+
+class TestPromptPool(unittest.IsolatedAsyncioTestCase):
+
+    async def test_miss_then_hits(self):
+        pool = prompts.PromptPool(size=10, low_water=3, chunk_size=4)
+        pool.register('numbers', counting_source())
+
+        self.assertEqual(pool.pop('numbers'), '0')
+        await pool.fill()
+        self.assertEqual(pool.stats()['numbers'], dict(hits=0, misses=1, generated=10, available=10))
+
+        self.assertEqual([pool.pop('numbers') for _ in range(7)], [str(n) for n in range(1, 8)])
+        self.assertEqual(pool.stats()['numbers']['hits'], 7)
+
+    async def test_background_refill(self):
+        pool = prompts.PromptPool(size=8, low_water=4, chunk_size=2)
+        pool.register('numbers', counting_source())
+        runner = asyncio.create_task(pool.run())
+        self.addCleanup(runner.cancel)
+
+        await asyncio.sleep(0.01)
+        self.assertEqual(pool.stats()['numbers']['available'], 8)
+
+        for _ in range(4):
+            pool.pop('numbers')
+        self.assertEqual(pool.stats()['numbers']['available'], 4)
+        pool.pop('numbers')
+
+        await asyncio.sleep(0.01)
+        self.assertEqual(pool.stats()['numbers']['available'], 8)
+
+    async def test_disabled(self):
+        pool = prompts.PromptPool(size=0, low_water=0)
+        pool.register('numbers', counting_source())
+        await pool.fill()
+        self.assertEqual(pool.pop('numbers'), '0')
+        self.assertEqual(pool.stats()['numbers'], dict(hits=0, misses=1, generated=0, available=0))
+
+    async def test_pop_avoids_recent(self):
+        pool = prompts.PromptPool(size=4, low_water=1)
+        pool.register('letters', lambda count: ['a', 'a', 'b', 'c'][:count])
+        await pool.fill()
+
+        recent = grammar.RecentFilter(4)
+        self.assertEqual(pool.pop('letters', recent=recent), 'a')
+        self.assertEqual(pool.pop('letters', recent=recent), 'b')
+        self.assertEqual((recent.checks, recent.hits), (3, 1))
+
+    def test_recent_filters(self):
+        filters = prompts.RecentFilters(size=2, retries=1)
+        self.assertIsNone(filters.get(None))
+        self.assertIs(filters.get(1), filters.get(1))
+        self.assertIsNot(filters.get(1), filters.get(2))
+        filters.get(1).admit('a')
+        filters.get(1).admit('a')
+        self.assertEqual(filters.stats(), dict(guilds=2, evicted=0, checks=2, hits=1, hit_rate=0.5))
+        self.assertIsNone(prompts.RecentFilters(size=0, retries=1).get(1))
+
+    def test_recent_filters_bounded(self):
+        filters = prompts.RecentFilters(size=2, retries=1, max_guilds=2)
+        filters.get(1).admit('a')
+        filters.get(2).admit('b')
+        first = filters.get(1)
+        # Guild 2 is the least recently used, so it makes room for guild 3
+        filters.get(3)
+        self.assertIs(filters.get(1), first)
+        self.assertEqual(list(filters._filters), [3, 1])
+        self.assertEqual(filters.stats(), dict(guilds=2, evicted=1, checks=2, hits=0, hit_rate=0.0))
+
+    def test_random_maker_prompts(self):
+        generated = prompts.make_random_prompts(dict(subject='a frog', unrelated='ignored'), 3)
+        self.assertEqual(len(generated), 3)
+        for prompt in generated:
+            self.assertTrue(prompt.startswith('a frog '))
+
+    async def test_stream_prompts(self):
+        chunks = [chunk async for chunk in prompts.stream_prompts('karma', 10, start='ROOT', chunk_size=4)]
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+
+        chunks = [chunk async for chunk in prompts.stream_prompts('maker', 3, args=dict(subject='a frog'))]
+        self.assertTrue(all(prompt.startswith('a frog ') for prompt in chunks[0]))
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from stabby import result_cache
+
+
+def cached(size: int, tag: str = '') -> result_cache.CachedResult:
+    return result_cache.CachedResult(data=b'x' * size, filename='{}.png'.format(tag), reprompt=dict(seed=1))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_key(self):
+        key = result_cache.result_key(dict(prompt='a frog', seed=1), dict(palette=None))
+        self.assertEqual(key, result_cache.result_key(dict(seed=1, prompt='a frog'), dict(palette=None)))
+        self.assertNotEqual(key, result_cache.result_key(dict(prompt='a frog', seed=2), dict(palette=None)))
+        self.assertNotEqual(key, result_cache.result_key(dict(prompt='a frog', seed=1), dict(palette='AAAA')))
+
+    def test_memory_lru(self):
+        cache = result_cache.ResultCache(max_bytes=25)
+        cache.put('a', cached(10, 'a'))
+        cache.put('b', cached(10, 'b'))
+        self.assertEqual(cache.get('a').filename, 'a.png')
+        cache.put('c', cached(10, 'c'))
+
+        # 'b' was the least recently used once 'a' was read
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        cache.put('huge', cached(100))
+        self.assertIsNone(cache.get('huge'))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['bytes']), (2, 2, 1, 20))
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = result_cache.ResultCache(max_bytes=10, cache_dir=cache_dir, max_disk_bytes=10 ** 6)
+            cache.put('a', cached(8, 'a'))
+            cache.put('b', cached(8, 'b'))
+
+            # Pushed out of memory, but still on disk
+            self.assertEqual(cache.get('a').filename, 'a.png')
+            self.assertEqual((cache.hits, cache.disk_hits), (0, 1))
+
+            restarted = result_cache.ResultCache(max_bytes=10, cache_dir=cache_dir, max_disk_bytes=10 ** 6)
+            self.assertEqual(restarted.get('b').data, b'x' * 8)
+            self.assertEqual(restarted.stats()['disk_entries'], 2)
+
+            with open(os.path.join(cache_dir, 'a.result'), 'wb') as file:
+                file.write(b'not a pickle')
+            with self.assertLogs(result_cache.logger, 'WARNING'):
+                self.assertIsNone(restarted.get('a'))
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, 'a.result')))
+
+    def test_fetch_and_store(self):
+        async def run(cache: result_cache.ResultCache) -> None:
+            loop = asyncio.get_running_loop()
+            with mock.patch.object(loop, 'run_in_executor', wraps=loop.run_in_executor) as run_in_executor:
+                await cache.store('a', cached(8, 'a'))
+                await cache.store('b', cached(8, 'b'))
+                self.assertEqual((await cache.fetch('b')).filename, 'b.png')
+                self.assertEqual((await cache.fetch('a')).filename, 'a.png')
+                self.assertIsNone(await cache.fetch('c'))
+            # Only the disk tier leaves the event loop, memory hits are answered on it
+            self.assertEqual(run_in_executor.call_count, 4)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = result_cache.ResultCache(max_bytes=10, cache_dir=cache_dir, max_disk_bytes=10 ** 6)
+            asyncio.run(run(cache))
+            self.assertEqual((cache.hits, cache.disk_hits, cache.misses), (1, 1, 1))
+
+    def test_disk_budget(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = result_cache.ResultCache(max_bytes=0, cache_dir=cache_dir, max_disk_bytes=10 ** 6)
+            cache.put('a', cached(8))
+            # Room for exactly two entries of this size
+            cache.max_disk_bytes = cache.stats()['disk_bytes'] * 2
+            cache.put('b', cached(8))
+            cache.put('c', cached(8))
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['b.result', 'c.result'])
+            self.assertEqual(cache.stats()['disk_evictions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from sqlalchemy import create_engine, inspect, text
+
+from stabby import schema
+
+
+class TestSchema(unittest.TestCase):
+
+    def test_add_missing_columns(self):
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            # generation_server as created before it had a url
+            connection.execute(text(
+                'CREATE TABLE generation_server (id INTEGER PRIMARY KEY, created_at DATETIME, '
+                'owner_id BIGINT NOT NULL, token VARCHAR NOT NULL, status VARCHAR NOT NULL)'))
+            connection.execute(text("INSERT INTO generation_server (owner_id, token, status) VALUES (1, 'secret', 'Online')"))
+
+        with self.assertLogs(schema.logger, 'INFO'):
+            schema.add_missing_columns(engine)
+        columns = {column['name'] for column in inspect(engine).get_columns('generation_server')}
+        self.assertIn('url', columns)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('SELECT token, url FROM generation_server')).all(), [('secret', None)])
+
+        # Nothing left to add the second time around
+        with self.assertNoLogs(schema.logger, 'INFO'):
+            schema.add_missing_columns(engine)
+
+
+if __name__ == '__main__':
+    unittest.main()
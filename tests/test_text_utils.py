@@ -1,6 +1,6 @@
 import unittest
 
-from stabby import text_utils
+from stabby import grammar, text_utils
 from tests.helpers import with_params
 
 
@@ -27,3 +27,22 @@ class TestTextUtils(unittest.TestCase):
         got_title, got_description = text_utils.prompt_to_overlay(prompt)
         self.assertEqual(got_title, title)
         self.assertEqual(got_description, description)
+
+    @with_params('Template prompts', [
+        (dict(subject='cat', action='sitting', style='oil painting', mood='calm'), 'cat sitting, oil painting, calm'),
+        (dict(subject='cat', object='hat', action='sitting', perspective='wide', quality='hd'), 'cat hat sitting, wide hd , '),
+        (dict(subject='cat'), 'cat , , '),
+    ])
+    def test_join_template_prompt(self, prompt, text):
+        self.assertEqual(text_utils.join_template_prompt(prompt), text)
+
+    def test_template_grammar_fill_many(self):
+        language = grammar.Grammar('maker_grammar.txt')
+        filled = text_utils.template_grammar_fill_many(dict(subject='cat', mood=None, style=None), language, 10, True)
+        self.assertEqual(len(filled), 10)
+        for prompt in filled:
+            self.assertEqual(list(prompt.keys()), ['subject', 'mood', 'style'])
+            self.assertEqual(prompt['subject'], 'cat')
+
+        unfilled = text_utils.template_grammar_fill_many(dict(subject='cat', mood=None), language, 2, False)
+        self.assertEqual(unfilled, [dict(subject='cat')] * 2)